@@ -0,0 +1,35 @@
+"""
+-----------> BENCHMARK <-----------
+  read(OBJ): python vs numpy
+
+Run from the repository root:
+    python benchmarks/obj_parser.py
+"""
+import glob
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from libs import basic_shapes as bs
+
+REPEAT = 3
+COLOR = (0.4, 1, 0.4)
+
+if __name__ == '__main__':
+    print(f"{'file':<20}{'status':>8}{'python [s]':>12}{'numpy [s]':>12}{'speedup':>10}")
+    for filename in sorted(glob.glob('libs/obj/*.obj')):
+        # Files written with 'v  x y z' need status=True, as loaded by libs/models.py
+        with open(filename) as file:
+            status = any(line.startswith('v  ') for line in file)
+
+        reference = bs.parseOBJ(filename, COLOR, status)
+        shape = bs.parseOBJNumpy(filename, COLOR, status)
+        assert np.array_equal(np.array(reference.vertices, dtype=np.float32), shape.vertices), filename
+        assert np.array_equal(np.array(reference.indices, dtype=np.uint32), shape.indices), filename
+
+        python = min(timeit.repeat(lambda: bs.parseOBJ(filename, COLOR, status), number=1, repeat=REPEAT))
+        numpy = min(timeit.repeat(lambda: bs.parseOBJNumpy(filename, COLOR, status), number=1, repeat=REPEAT))
+        print(f"{os.path.basename(filename):<20}{str(status):>8}{python:>12.4f}{numpy:>12.4f}{python / numpy:>9.1f}x")
@@ -0,0 +1,61 @@
+"""
+-----------> BENCHMARK <-----------
+  tail interpolation: get_pos / get_theta vs get_pos_batch / get_theta_batch
+
+Run from the repository root:
+    python benchmarks/tail_interpolation.py
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from libs.models import get_pos, get_theta, get_pos_batch, get_theta_batch
+
+REPEAT = 5
+SEGMENTS = 10000
+SIZE = 100
+GRID = 1 / SIZE
+I, M = 3, 7
+
+
+def snake(n, seed=0):
+    # A random walk on the board: consecutive cells and the angles the pieces face
+    rng = np.random.default_rng(seed)
+    steps = [(1, 0), (0, -1), (-1, 0), (0, 1)]
+    angles = [0, np.pi / 2, np.pi, 3 * np.pi / 2]
+    cells, thetas = [(SIZE // 2, SIZE // 2)], [0]
+    for k in rng.integers(0, 4, n):
+        x, y = cells[-1]
+        cells.append(((x + steps[k][0]) % SIZE, (y + steps[k][1]) % SIZE))
+        thetas.append(angles[k])
+    return cells, thetas
+
+
+def scalar(cells, thetas):
+    positions = [get_pos(GRID, SIZE, None, cells[t + 1], get_pos(GRID, SIZE, cells[t]), i=I, m=M)
+                 for t in range(len(cells) - 1)]
+    angles = [get_theta(thetas[t], thetas[t + 1], i=I, m=M) for t in range(len(thetas) - 1)]
+    return positions, angles
+
+
+def batch(cells, thetas):
+    positions = get_pos_batch(GRID, SIZE, None, cells[1:], get_pos_batch(GRID, SIZE, cells[:-1]), i=I, m=M)
+    angles = get_theta_batch(thetas[:-1], thetas[1:], i=I, m=M)
+    return positions, angles
+
+
+if __name__ == '__main__':
+    cells, thetas = snake(SEGMENTS)
+
+    reference = scalar(cells, thetas)
+    result = batch(cells, thetas)
+    assert np.array_equal(np.array(reference[0]), result[0])
+    assert np.array_equal(np.array(reference[1]), result[1])
+
+    python = min(timeit.repeat(lambda: scalar(cells, thetas), number=1, repeat=REPEAT))
+    numpy = min(timeit.repeat(lambda: batch(cells, thetas), number=1, repeat=REPEAT))
+    print(f"{'segments':<12}{'python [s]':>12}{'numpy [s]':>12}{'speedup':>10}")
+    print(f"{SEGMENTS:<12}{python:>12.4f}{numpy:>12.4f}{python / numpy:>9.1f}x")
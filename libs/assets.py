@@ -0,0 +1,117 @@
+"""
+F. Urrutia V., CC3501, 2020-1
+-----------> ASSETS <-----------
+Registro de mallas compartidas:
+-MeshRegistry
+-registry: instancia global
+-Preloader: lectura de OBJ e imagenes en paralelo
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from libs import basic_shapes as bs, easy_shaders as es
+
+
+# Grid resolutions of the simplified levels of detail (see basic_shapes.simplifyShape)
+LOD_RESOLUTIONS = (48, 20)
+
+
+def objKey(filename, color, status=True, weld=False, lod=None):
+    return 'obj', filename, tuple(color), status, weld, lod
+
+
+class MeshRegistry(object):
+    # Each mesh is loaded and uploaded to the GPU once, every user gets the same GPUShape.
+    # References are counted so unused meshes can be freed with collect()
+
+    def __init__(self):
+        self.shapes = {}
+        self.refs = {}
+        # Shapes being decoded by a Preloader, as futures
+        self.pending = {}
+        # How each Shape was made, to get it back on the CPU (see source)
+        self.factories = {}
+
+    def acquire(self, key, factory, wrapMode=None, filterMode=None, mipmap=False, source=None, layout=None):
+        # source: makes the Shape again later, when factory should not be kept (default: factory itself)
+        # layout: vertex layout for toGPUShape, guessed when not given
+        if key not in self.shapes:
+            self.factories[key] = factory if source is None else source
+            shape = factory()
+            gpuShape = es.toGPUShape(shape, wrapMode, filterMode, mipmap, layout)
+            self.shapes[key] = gpuShape
+            self.refs[key] = 0
+        self.refs[key] += 1
+        return self.shapes[key]
+
+    def acquireOBJ(self, filename, color, status=True, weld=False, lod=None):
+        key = objKey(filename, color, status, weld, lod)
+        load = lambda: bs.readOBJ(filename, color, status, weld=weld, lod=lod)
+        # readOBJ always gives position, color and normal
+        if key in self.pending:
+            # the preloaded Shape is not kept by the future: later copies come from the disk cache
+            return self.acquire(key, self.pending.pop(key).result, source=load, layout=es.LAYOUT_COLOR_NORMALS)
+        return self.acquire(key, load, layout=es.LAYOUT_COLOR_NORMALS)
+
+    def acquireOBJLevels(self, filename, color, status=True, weld=False, resolutions=LOD_RESOLUTIONS):
+        # Full detail mesh followed by its simplified versions, generated once and cached on disk
+        levels = [self.acquireOBJ(filename, color, status, weld)]
+        for lod in resolutions:
+            levels.append(self.acquireOBJ(filename, color, status, weld, lod))
+        return levels
+
+    def source(self, gpuShape):
+        # The Shape uploaded as gpuShape, made again (OBJ files come from the disk cache)
+        for key, shape in self.shapes.items():
+            if shape is gpuShape:
+                return self.factories[key]()
+        raise KeyError("GPUShape not owned by the registry.")
+
+    def release(self, gpuShape):
+        for key, shape in self.shapes.items():
+            if shape is gpuShape:
+                assert self.refs[key] > 0, "Mesh released more times than acquired."
+                self.refs[key] -= 1
+                return
+        raise KeyError("GPUShape not owned by the registry.")
+
+    def collect(self):
+        # Meshes are kept while unreferenced, so they are not reloaded in the middle of a game
+        for key in [key for key, count in self.refs.items() if count == 0]:
+            es.deleteGPUShape(self.shapes.pop(key))
+            del self.refs[key]
+            del self.factories[key]
+
+    def clear(self):
+        for shape in self.shapes.values():
+            es.deleteGPUShape(shape)
+        self.shapes = {}
+        self.refs = {}
+        self.factories = {}
+
+
+registry = MeshRegistry()
+
+
+class Preloader(object):
+    # Decodes OBJ and uncached image files in worker processes while the main thread creates the
+    # window and compiles the shaders. Only the GPU upload is left to the main thread.
+
+    def __init__(self, meshes, images, workers=None):
+        self.executor = ProcessPoolExecutor(workers)
+        for mesh in meshes:
+            key = objKey(**mesh)
+            if key not in registry.shapes and key not in registry.pending:
+                registry.pending[key] = self.executor.submit(
+                    bs.readOBJ, mesh['filename'], mesh['color'], mesh.get('status', True),
+                    weld=mesh.get('weld', False), lod=mesh.get('lod'))
+        for image in images:
+            # Cached images are memory-mapped on the main thread: a worker would pickle them back as copies
+            if image not in es.pendingImages and not os.path.exists(es.textureCachePath(image)[1]):
+                es.pendingImages[image] = self.executor.submit(es.loadImage, image)
+
+    def shutdown(self):
+        # Results not used by then are discarded
+        registry.pending = {}
+        es.pendingImages.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -5,8 +5,25 @@ vertices and indices for simple shapes
 
 F. Urrutia V., CC3501, 2020-1
 add createTextureQuad(REPEAT), createTextureNormalsQuad(REPEAT), read(OBJ)
+add on-disk cache for read(OBJ)
+add vectorized (NumPy) parser for read(OBJ)
+add vertex welding (weldShape) for read(OBJ)
+add streaming (bounded memory) parser for read(OBJ)
+add level of detail generation (simplifyShape) for read(OBJ)
 """
 
+from array import array
+import hashlib
+import os
+
+import numpy as np
+
+# Parsed OBJ files are stored next to their sources, inside this folder
+OBJ_CACHE_DIR = '.cache'
+# Part of every key: bumped when the shapes made from the same file change (2: simplifyShape drops
+# unreferenced vertices)
+OBJ_CACHE_VERSION = 2
+
 
 # A simple class container to store vertices and indices that define a shape
 class Shape:
@@ -387,7 +404,7 @@ def readFaceVertex(faceDescription):
     return faceVertex
 
 
-def readOBJ(filename, color, status=True):
+def parseOBJ(filename, color, status=True):
     vertices = []
     normals = []
     textCoords = []
@@ -442,3 +459,285 @@ def readOBJ(filename, color, status=True):
             index += 3
 
         return Shape(vertexData, indices)
+
+
+def parseOBJNumpy(filename, color, status=True):
+    with open(filename, 'r') as file:
+        lines = file.read().splitlines()
+
+    vertexLines = []
+    normalLines = []
+    faceLines = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith('v '):
+            # Same convention as parseOBJ: with status, the first field after 'v' is skipped
+            vertexLines.append(line[2:].split(' ', 1)[1] if status else line[2:])
+        elif line.startswith('vn '):
+            normalLines.append(line[3:])
+        elif line.startswith('f '):
+            faceLines.append(line[2:])
+
+    # Every record is tokenized in a single pass and converted in bulk
+    vertices = np.array(' '.join(vertexLines).split(), dtype=np.float32).reshape(len(vertexLines), -1)[:, :3]
+    normals = np.array(' '.join(normalLines).split(), dtype=np.float32).reshape(len(normalLines), -1)[:, :3]
+
+    corners = [face.split() for face in faceLines]
+    cornerCount = np.array([len(face) for face in corners], dtype=np.int64)
+    assert np.all(cornerCount >= 3), "Faces must have at least 3 vertices."
+
+    # Missing texture coordinates ('v//n') are filled in, they are not used anyway
+    cornerText = ' '.join(' '.join(face) for face in corners).replace('//', '/0/')
+    faceVertex = np.array(cornerText.replace('/', ' ').split(), dtype=np.int64)
+    assert len(faceVertex) == 3 * cornerCount.sum(), "Only faces where its vertices require 3 indices are defined."
+    faceVertex = faceVertex.reshape(-1, 3)
+
+    # Fan triangulation, as parseOBJ: (0, 1, 2), then (j + 1, j + 2, 0) for every following triangle j
+    triangleCount = cornerCount - 2
+    faceStart = np.cumsum(cornerCount) - cornerCount
+    triangleFace = np.repeat(np.arange(len(corners)), triangleCount)
+    j = np.arange(triangleCount.sum()) - np.repeat(np.cumsum(triangleCount) - triangleCount, triangleCount)
+    local = np.stack([np.where(j == 0, 0, j + 1), np.where(j == 0, 1, j + 2), np.where(j == 0, 2, 0)], axis=1)
+    corner = (faceStart[triangleFace][:, None] + local).reshape(-1)
+
+    vertexData = np.empty((len(corner), 9), dtype=np.float32)
+    vertexData[:, 0:3] = vertices[faceVertex[corner, 0] - 1]
+    vertexData[:, 3:6] = color
+    vertexData[:, 6:9] = normals[faceVertex[corner, 2] - 1]
+
+    indices = np.arange(len(corner), dtype=np.uint32)
+
+    return Shape(vertexData.reshape(-1), indices)
+
+
+def weldShape(shape, stride=9):
+    # Identical vertices (every attribute equal) are merged into a single entry
+    vertexData = np.ascontiguousarray(np.asarray(shape.vertices, dtype=np.float32).reshape(-1, stride))
+    indices = np.asarray(shape.indices, dtype=np.uint32)
+
+    # Each row is compared as raw bytes, which is much faster than a lexicographic float sort
+    rows = vertexData.view(np.dtype((np.void, vertexData.dtype.itemsize * stride))).reshape(-1)
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+
+    # Unique vertices are kept in order of first use, so neighbouring triangles stay close in memory
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    weldedVertices = vertexData[first[order]].reshape(-1)
+    weldedIndices = rank[inverse.reshape(-1)][indices].astype(np.uint32)
+
+    return Shape(weldedVertices, weldedIndices, shape.textureFileName)
+
+
+def iterOBJLines(filename, chunkSize=1 << 20):
+    # The file is read in fixed size chunks, only the current chunk is kept in memory
+    with open(filename, 'r') as file:
+        rest = ''
+        while True:
+            chunk = file.read(chunkSize)
+            if not chunk:
+                break
+            lines = (rest + chunk).split('\n')
+            rest = lines.pop()
+            yield from lines
+        if rest:
+            yield rest
+
+
+def parseOBJStream(filename, color, status=True, chunkSize=1 << 20):
+    # Records are appended straight into typed arrays (4 bytes per value) instead of nested lists
+    vertices = array('f')
+    normals = array('f')
+    vertexIndices = array('i')
+    normalIndices = array('i')
+
+    for line in iterOBJLines(filename, chunkSize):
+        aux = line.strip().split(' ')
+        if aux[0] == 'v':
+            vertices.extend(float(coord) for coord in (aux[2:5] if status else aux[1:4]))
+        elif aux[0] == 'vn':
+            normals.extend(float(coord) for coord in aux[1:4])
+        elif aux[0] == 'f':
+            faceVertices = [readFaceVertex(faceVertex) for faceVertex in aux[1:]]
+            # Same fan triangulation as parseOBJ
+            for triangle in [(0, 1, 2)] + [(i - 1, i, 0) for i in range(3, len(faceVertices))]:
+                for i in triangle:
+                    vertexIndices.append(faceVertices[i][0] - 1)
+                    normalIndices.append(faceVertices[i][2] - 1)
+
+    # Only the final interleaved buffer is allocated, the typed arrays are read without copies
+    vertices = np.frombuffer(vertices, dtype=np.float32).reshape(-1, 3)
+    normals = np.frombuffer(normals, dtype=np.float32).reshape(-1, 3)
+    count = len(vertexIndices)
+
+    vertexData = np.empty((count, 9), dtype=np.float32)
+    vertexData[:, 0:3] = vertices[np.frombuffer(vertexIndices, dtype=np.int32)]
+    vertexData[:, 3:6] = color
+    vertexData[:, 6:9] = normals[np.frombuffer(normalIndices, dtype=np.int32)]
+
+    return Shape(vertexData.reshape(-1), np.arange(count, dtype=np.uint32))
+
+
+def simplifyShape(shape, resolution, stride=9):
+    # Vertex clustering: the bounding box is split in a grid with resolution cells along its largest side,
+    # vertices in the same cell are merged and the triangles that collapse are removed
+    vertexData = np.asarray(shape.vertices, dtype=np.float32).reshape(-1, stride)
+    triangles = np.asarray(shape.indices, dtype=np.int64).reshape(-1, 3)
+
+    positions = vertexData[:, 0:3]
+    low = positions.min(axis=0)
+    cellSize = max(float((positions.max(axis=0) - low).max()) / resolution, 1e-12)
+    cells = np.floor((positions - low) / cellSize).astype(np.int64)
+    _, cluster = np.unique(cells, axis=0, return_inverse=True)
+    cluster = cluster.reshape(-1)
+    count = cluster.max() + 1
+
+    # Each cluster is represented by the average of its vertices, normals are normalized again
+    weights = np.bincount(cluster, minlength=count).astype(np.float32)[:, None]
+    simplified = np.zeros((count, stride), dtype=np.float32)
+    np.add.at(simplified, cluster, vertexData)
+    simplified /= weights
+    normals = simplified[:, 6:9]
+    norm = np.linalg.norm(normals, axis=1, keepdims=True)
+    simplified[:, 6:9] = np.where(norm > 0, normals / np.maximum(norm, 1e-12), normals)
+
+    triangles = cluster[triangles]
+    keep = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) \
+        & (triangles[:, 0] != triangles[:, 2])
+    triangles = np.unique(triangles[keep], axis=0)
+
+    # Clusters left only in removed triangles are dropped, so every vertex is referenced
+    used, triangles = np.unique(triangles, return_inverse=True)
+    simplified = simplified[used]
+
+    return Shape(simplified.reshape(-1), triangles.reshape(-1).astype(np.uint32), shape.textureFileName)
+
+
+def boundingSphere(shape, stride=9):
+    # Center of the bounding box and the distance to its farthest vertex. shape: a Shape or its vertex array
+    vertices = shape.vertices if isinstance(shape, Shape) else shape
+    positions = np.asarray(vertices, dtype=np.float32).reshape(-1, stride)[:, 0:3]
+    center = (positions.min(axis=0) + positions.max(axis=0)) / 2
+    radius = float(np.linalg.norm(positions - center, axis=1).max())
+    return center, radius
+
+
+def mergeShapes(parts, stride=9):
+    # parts: (shape, transform) pairs, merged in a single shape drawn with the identity as model.
+    # Positions and normals (the last 3 floats of each vertex) are moved by each transform
+    vertices = []
+    indices = []
+    offset = 0
+    for shape, transform in parts:
+        vertexData = np.array(shape.vertices, dtype=np.float32).reshape(-1, stride)
+        transform = np.asarray(transform, dtype=np.float64)
+        linear = transform[0:3, 0:3]
+        vertexData[:, 0:3] = vertexData[:, 0:3] @ linear.T + transform[0:3, 3]
+        # same normal matrix as the shaders: transpose(inverse(model))
+        vertexData[:, stride - 3:stride] = vertexData[:, stride - 3:stride] @ np.linalg.inv(linear)
+        vertices.append(vertexData.reshape(-1))
+        indices.append(np.asarray(shape.indices, dtype=np.uint32) + offset)
+        offset += len(vertexData)
+
+    return Shape(np.concatenate(vertices), np.concatenate(indices), parts[0][0].textureFileName)
+
+
+# Available backends for readOBJ
+OBJ_PARSERS = {'python': parseOBJ, 'numpy': parseOBJNumpy, 'stream': parseOBJStream}
+
+# Files larger than this (bytes) are read by the streaming parser when readOBJ is given no parser
+STREAM_OBJ_SIZE = 64 << 20
+
+# Files are hashed and cache entries written in blocks of this size (bytes / values)
+CACHE_BLOCK = 1 << 20
+
+
+def objCacheKey(filename, color, status=True, weld=False, lod=None):
+    # The key starts with the hash of the file content, so any edit of the source invalidates the cache.
+    # The second part identifies the variant (arguments) of the same content
+    content = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(CACHE_BLOCK), b''):
+            content.update(block)
+    content = content.hexdigest()
+    variant = hashlib.sha1(repr((OBJ_CACHE_VERSION, tuple(float(c) for c in color), bool(status), bool(weld),
+                                 lod)).encode())
+    return f"{content}.{variant.hexdigest()[:16]}"
+
+
+def objCachePaths(filename, key):
+    folder = os.path.join(os.path.dirname(filename), OBJ_CACHE_DIR)
+    prefix = os.path.join(folder, f"{os.path.basename(filename)}.{key}")
+    return folder, prefix + '.vertices.npy', prefix + '.indices.npy'
+
+
+def loadOBJCache(filename, key):
+    _, verticesPath, indicesPath = objCachePaths(filename, key)
+    if not (os.path.exists(verticesPath) and os.path.exists(indicesPath)):
+        return None
+
+    try:
+        # Memory-mapped: the data is paged in by the OS when it is uploaded to the GPU
+        vertices = np.load(verticesPath, mmap_mode='r')
+        indices = np.load(indicesPath, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+    return Shape(vertices, indices)
+
+
+def saveOBJCache(filename, key, shape):
+    folder, verticesPath, indicesPath = objCachePaths(filename, key)
+    try:
+        os.makedirs(folder, exist_ok=True)
+
+        # Entries of older versions of the same file are no longer reachable
+        content = key.split('.')[0]
+        for entry in os.listdir(folder):
+            if entry.startswith(os.path.basename(filename) + '.') \
+                    and not entry.startswith(f"{os.path.basename(filename)}.{content}."):
+                os.remove(os.path.join(folder, entry))
+
+        for path, data, dtype in [(verticesPath, shape.vertices, np.float32),
+                                  (indicesPath, shape.indices, np.uint32)]:
+            # Arrays are written block by block, converted on the way, without a full copy.
+            # Write and rename, so a crash never leaves a truncated entry behind
+            data = np.asarray(data)
+            tmpPath = path + '.tmp'
+            out = np.lib.format.open_memmap(tmpPath, mode='w+', dtype=dtype, shape=(len(data),))
+            for start in range(0, len(data), CACHE_BLOCK):
+                out[start:start + CACHE_BLOCK] = data[start:start + CACHE_BLOCK]
+            out.flush()
+            del out
+            os.replace(tmpPath, path)
+    except OSError:
+        # The cache is an optimization only, a read-only folder must not break the loading
+        pass
+
+
+def readOBJ(filename, color, status=True, cache=True, parser=None, weld=False, lod=None):
+    # lod: grid resolution used by simplifyShape, None keeps the full detail
+    # parser: one of OBJ_PARSERS; by default 'numpy', or 'stream' for files larger than STREAM_OBJ_SIZE
+    if parser is None:
+        parser = 'stream' if os.path.getsize(filename) > STREAM_OBJ_SIZE else 'numpy'
+    parse = OBJ_PARSERS[parser]
+
+    def build():
+        shape = parse(filename, color, status)
+        if weld or lod is not None:
+            shape = weldShape(shape)
+        if lod is not None:
+            shape = simplifyShape(shape, lod)
+        return shape
+
+    if not cache:
+        return build()
+
+    key = objCacheKey(filename, color, status, weld, lod)
+    shape = loadOBJCache(filename, key)
+    if shape is None:
+        shape = build()
+        saveOBJCache(filename, key, shape)
+
+    return shape
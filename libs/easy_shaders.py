@@ -6,57 +6,358 @@ Simple Shaders
 
 from OpenGL.GL import *
 import OpenGL.GL.shaders
+import hashlib
+import os
 import numpy as np
 from PIL import Image
 
-from libs import basic_shapes as bs
+from libs import basic_shapes as bs, gl_state
 
 # We will use 32 bits data, so we have 4 bytes
 # 1 byte = 8 bits
 SIZE_IN_BYTES = 4
 
 
+# Every program binds its attributes to these locations before linking, so a VAO works with any of them.
+# A shape has either colors or texture coordinates, they share a location
+ATTRIBUTE_LOCATIONS = {'position': 0, 'color': 1, 'texCoords': 1, 'normal': 2}
+
+# Vertex layouts, (location, number of floats) of each attribute in order
+LAYOUT_COLOR = ((0, 3), (1, 3))
+LAYOUT_TEXTURE = ((0, 3), (1, 2))
+LAYOUT_COLOR_NORMALS = ((0, 3), (1, 3), (2, 3))
+LAYOUT_TEXTURE_NORMALS = ((0, 3), (1, 2), (2, 3))
+
+
+def layoutStride(layout):
+    return sum(size for _, size in layout)
+
+
+def vertexLayout(shape):
+    # Guessed from the texture and the number of floats per vertex (every vertex is used by some index)
+    if shape.textureFileName is not None:
+        candidates = [LAYOUT_TEXTURE, LAYOUT_TEXTURE_NORMALS]
+    else:
+        candidates = [LAYOUT_COLOR, LAYOUT_COLOR_NORMALS]
+    count = int(np.max(shape.indices)) + 1
+    for layout in candidates:
+        if len(shape.vertices) == count * layoutStride(layout):
+            return layout
+    raise ValueError("Unknown vertex layout, give it to toGPUShape.")
+
+
 # A simple class container to reference a shape on GPU memory
 class GPUShape:
     def __init__(self):
+        self.layout = None
         self.vao = 0
         self.vbo = 0
         self.ebo = 0
         self.texture = 0
         self.size = 0
+        # bounding sphere in local coordinates, set by toGPUShape (None for shapes without vertices)
+        self.center = None
+        self.radius = 0
+
+
+# Images being decoded in other processes (see assets.Preloader), as futures
+pendingImages = {}
 
+# Decoded RGBA8 textures are stored next to their sources, inside this folder
+TEXTURE_CACHE_DIR = '.cache'
 
-def textureSimpleSetup(texture, imgName, wrapMode, filterMode):
+
+def decodeImage(imgName):
+    image = Image.open(imgName)
+    if image.mode not in ("RGB", "RGBA"):
+        print("Image mode not supported.", image.mode)
+        raise Exception()
+
+    # Every level is RGBA8, from full size down to 1x1, as glTexImage2D expects them
+    image = image.convert("RGBA")
+    levels = [np.asarray(image, dtype=np.uint8)]
+    while image.size != (1, 1):
+        image = image.resize((max(1, image.size[0] // 2), max(1, image.size[1] // 2)), Image.BOX)
+        levels.append(np.asarray(image, dtype=np.uint8))
+    return levels
+
+
+def textureCachePath(imgName):
+    # The key depends on the file content, so any edit of the source invalidates the cache
+    with open(imgName, 'rb') as file:
+        key = hashlib.sha1(file.read()).hexdigest()
+    folder = os.path.join(os.path.dirname(imgName), TEXTURE_CACHE_DIR)
+    return folder, os.path.join(folder, f"{os.path.basename(imgName)}.{key}.rgba.npy")
+
+
+def loadTextureCache(path):
+    # Layout: level count, (height, width) per level, then the pixels of every level (uint32 header)
+    try:
+        blob = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+    count = int(blob[:4].view(np.uint32)[0])
+    dims = blob[4:4 + 8 * count].view(np.uint32).reshape(count, 2)
+    levels = []
+    offset = 4 + 8 * count
+    for height, width in dims:
+        size = int(height) * int(width) * 4
+        levels.append(blob[offset:offset + size].reshape(height, width, 4))
+        offset += size
+    return levels
+
+
+def saveTextureCache(imgName, folder, path, levels):
+    header = np.array([len(levels)] + [n for level in levels for n in level.shape[:2]], dtype=np.uint32)
+    blob = np.concatenate([header.view(np.uint8)] + [level.reshape(-1) for level in levels])
+    try:
+        os.makedirs(folder, exist_ok=True)
+
+        # Entries of older versions of the same image are no longer reachable
+        for entry in os.listdir(folder):
+            if entry.startswith(os.path.basename(imgName) + '.') and entry != os.path.basename(path):
+                os.remove(os.path.join(folder, entry))
+
+        # Write and rename, so a crash never leaves a truncated entry behind
+        with open(path + '.tmp', 'wb') as file:
+            np.save(file, blob)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        # The cache is an optimization only, a read-only folder must not break the loading
+        pass
+
+
+def loadImage(imgName):
+    folder, path = textureCachePath(imgName)
+    levels = loadTextureCache(path) if os.path.exists(path) else None
+    if levels is None:
+        levels = decodeImage(imgName)
+        saveTextureCache(imgName, folder, path, levels)
+    return levels
+
+
+def readImage(imgName):
+    if imgName in pendingImages:
+        return pendingImages[imgName].result()
+    return loadImage(imgName)
+
+
+def textureSimpleSetup(texture, imgName, wrapMode, filterMode, mipmap=False):
      # wrapMode: GL_REPEAT, GL_CLAMP_TO_EDGE
      # filterMode: GL_LINEAR, GL_NEAREST
+     # mipmap: minification uses the mipmap chain, useful for repeated textures seen from afar
 
-    glBindTexture(GL_TEXTURE_2D, texture)
+    gl_state.state.bindTexture(GL_TEXTURE_2D, texture)
 
     # texture wrapping params
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, wrapMode)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, wrapMode)
 
     # texture filtering params
-    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, filterMode)
+    minFilter = filterMode
+    if mipmap:
+        minFilter = GL_LINEAR_MIPMAP_LINEAR if filterMode == GL_LINEAR else GL_NEAREST_MIPMAP_NEAREST
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, minFilter)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, filterMode)
 
-    image = Image.open(imgName)
-    img_data = np.array(list(image.getdata()), np.uint8)
-
-    if image.mode == "RGB":
-        internalFormat = GL_RGB
-        format = GL_RGB
-    elif image.mode == "RGBA":
-        internalFormat = GL_RGBA
-        format = GL_RGBA
-    else:
-        print("Image mode not supported.", image.mode)
-        raise Exception()
-
-    glTexImage2D(GL_TEXTURE_2D, 0, internalFormat, image.size[0], image.size[1], 0, format, GL_UNSIGNED_BYTE, img_data)
-
-
-def toGPUShape(shape, wrapMode=None, filterMode=None):
+    levels = readImage(imgName)
+
+    # Every level comes already decoded (and mipmapped) from the cache, nothing is computed here
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+    if not mipmap:
+        levels = levels[:1]
+    for i, level in enumerate(levels):
+        glTexImage2D(GL_TEXTURE_2D, i, GL_RGBA8, level.shape[1], level.shape[0], 0, GL_RGBA, GL_UNSIGNED_BYTE,
+                     np.ascontiguousarray(level))
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+
+
+# Shapes made from the same image, with the same parameters, share one texture:
+# (path, wrapMode, filterMode, mipmap) -> texture, and texture -> [key, shapes using it]
+textureNames = {}
+textureRefs = {}
+
+
+def acquireTexture(imgName, wrapMode, filterMode, mipmap=False):
+    key = (os.path.abspath(imgName), wrapMode, filterMode, mipmap)
+    if key not in textureNames:
+        texture = glGenTextures(1)
+        textureSimpleSetup(texture, imgName, wrapMode, filterMode, mipmap)
+        textureNames[key] = texture
+        textureRefs[texture] = [key, 0]
+    texture = textureNames[key]
+    textureRefs[texture][1] += 1
+    return texture
+
+
+def retainTexture(texture):
+    # One more shape uses a texture already acquired
+    textureRefs[texture][1] += 1
+
+
+def releaseTexture(texture):
+    # True when no shape uses texture any more, it can be deleted
+    if texture not in textureRefs:
+        return True
+    textureRefs[texture][1] -= 1
+    if textureRefs[texture][1] > 0:
+        return False
+    key, _ = textureRefs.pop(texture)
+    del textureNames[key]
+    return True
+
+
+# Linked program binaries are stored here, they only work with the driver that produced them
+SHADER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), TEXTURE_CACHE_DIR)
+
+
+def programCachePath(vertexSource, fragmentSource):
+    # The key covers both sources, the attribute locations and the driver identity,
+    # a driver update invalidates the cache
+    key = hashlib.sha1()
+    for name in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+        key.update(glGetString(name) or b'')
+        key.update(b'\0')
+    key.update(repr(sorted(ATTRIBUTE_LOCATIONS.items())).encode())
+    key.update(vertexSource.encode())
+    key.update(b'\0')
+    key.update(fragmentSource.encode())
+    return os.path.join(SHADER_CACHE_DIR, f"program.{key.hexdigest()}.bin")
+
+
+def loadProgramBinary(path):
+    # Layout: binary format (uint32), then the driver blob
+    try:
+        with open(path, 'rb') as file:
+            data = np.frombuffer(file.read(), dtype=np.uint8)
+    except OSError:
+        return None
+    if len(data) <= 4:
+        return None
+
+    program = glCreateProgram()
+    try:
+        glProgramBinary(program, int(data[:4].view(np.uint32)[0]), data[4:], len(data) - 4)
+        if glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE:
+            return program
+    except OpenGL.error.GLError:
+        pass
+
+    # Rejected (unknown format, different driver build...), the caller compiles again
+    glDeleteProgram(program)
+    return None
+
+
+def saveProgramBinary(program, path):
+    length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+    if length <= 0:
+        return
+
+    binary = np.empty(length, dtype=np.uint8)
+    written = np.zeros(1, dtype=np.int32)
+    binaryFormat = np.zeros(1, dtype=np.uint32)
+    glGetProgramBinary(program, length, written, binaryFormat, binary)
+    try:
+        os.makedirs(SHADER_CACHE_DIR, exist_ok=True)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(binaryFormat.tobytes())
+            file.write(binary[:written[0]].tobytes())
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass
+
+
+def linkProgram(vertexSource, fragmentSource, retrievable=False):
+    # Compiles and links both shaders, with the attributes at ATTRIBUTE_LOCATIONS
+    shaders = [OpenGL.GL.shaders.compileShader(vertexSource, GL_VERTEX_SHADER),
+               OpenGL.GL.shaders.compileShader(fragmentSource, GL_FRAGMENT_SHADER)]
+    program = glCreateProgram()
+    for shader in shaders:
+        glAttachShader(program, shader)
+    # Locations and hints must be given before linking, names missing in the shaders are ignored
+    for name, location in ATTRIBUTE_LOCATIONS.items():
+        glBindAttribLocation(program, location, name)
+    if retrievable:
+        glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+    glLinkProgram(program)
+    if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+        raise RuntimeError(f"Link failure: {glGetProgramInfoLog(program)}")
+    for shader in shaders:
+        glDetachShader(program, shader)
+        glDeleteShader(shader)
+    return program
+
+
+def cachedProgram(vertexSource, fragmentSource):
+    # Same as linkProgram, but the linked program is reused between launches
+    if not glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS):
+        return linkProgram(vertexSource, fragmentSource)
+
+    path = programCachePath(vertexSource, fragmentSource)
+    program = loadProgramBinary(path) if os.path.exists(path) else None
+    if program is not None:
+        return program
+
+    program = linkProgram(vertexSource, fragmentSource, retrievable=True)
+    saveProgramBinary(program, path)
+    return program
+
+
+class UniformLocations(dict):
+    # Unknown (or optimized out) names get location -1, which glUniform* silently ignores
+    def __missing__(self, name):
+        return -1
+
+
+# Base of the shader programs: locations of every active uniform and attribute are read once,
+# after linking, so no string lookup happens while drawing
+class ShaderProgram:
+
+    def setupLocations(self):
+        self.uniforms = UniformLocations()
+        for i in range(glGetProgramiv(self.shaderProgram, GL_ACTIVE_UNIFORMS)):
+            name, size, _ = glGetActiveUniform(self.shaderProgram, i)
+            name = name.decode() if isinstance(name, bytes) else name
+            self.uniforms[name] = glGetUniformLocation(self.shaderProgram, name)
+            # arrays are reported as 'name[0]'
+            if name.endswith('[0]'):
+                self.uniforms[name[:-3]] = self.uniforms[name]
+
+        self.attributes = UniformLocations()
+        for i in range(glGetProgramiv(self.shaderProgram, GL_ACTIVE_ATTRIBUTES)):
+            name, size, _ = glGetActiveAttrib(self.shaderProgram, i)
+            name = name.decode() if isinstance(name, bytes) else name
+            self.attributes[name] = glGetAttribLocation(self.shaderProgram, name)
+
+    # The setters expect this program to be in use, values already in the program are not sent again
+    def uniform1f(self, name, x):
+        location = self.uniforms[name]
+        if gl_state.state.uniform(self.shaderProgram, location, x):
+            glUniform1f(location, x)
+
+    def uniform1ui(self, name, x):
+        location = self.uniforms[name]
+        if gl_state.state.uniform(self.shaderProgram, location, x):
+            glUniform1ui(location, x)
+
+    def uniform3f(self, name, x, y, z):
+        location = self.uniforms[name]
+        if gl_state.state.uniform(self.shaderProgram, location, (x, y, z)):
+            glUniform3f(location, x, y, z)
+
+    def uniformMatrix4fv(self, name, matrix):
+        # matrices are row-major, as built by transformations
+        location = self.uniforms[name]
+        if gl_state.state.uniformMatrix(self.shaderProgram, location, matrix):
+            glUniformMatrix4fv(location, 1, GL_TRUE, matrix)
+
+    def use(self):
+        gl_state.state.useProgram(self.shaderProgram)
+
+
+def toGPUShape(shape, wrapMode=None, filterMode=None, mipmap=False, layout=None):
+    # layout: one of the LAYOUT_* tuples, guessed from the shape when not given
     assert isinstance(shape, bs.Shape)
 
     vertexData = np.array(shape.vertices, dtype=np.float32)
@@ -70,24 +371,52 @@ def toGPUShape(shape, wrapMode=None, filterMode=None):
     gpuShape.vbo = glGenBuffers(1)
     gpuShape.ebo = glGenBuffers(1)
 
+    # The element buffer binding is part of the VAO state, so the shape's own VAO is bound first
+    gl_state.state.bindVertexArray(gpuShape.vao)
+
     # Vertex data must be attached to a Vertex Buffer Object (VBO)
-    glBindBuffer(GL_ARRAY_BUFFER, gpuShape.vbo)
+    gl_state.state.bindBuffer(GL_ARRAY_BUFFER, gpuShape.vbo)
     glBufferData(GL_ARRAY_BUFFER, len(vertexData) * SIZE_IN_BYTES, vertexData, GL_STATIC_DRAW)
 
     # Connections among vertices are stored in the Elements Buffer Object (EBO)
-    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, gpuShape.ebo)
+    gl_state.state.bindBuffer(GL_ELEMENT_ARRAY_BUFFER, gpuShape.ebo)
     glBufferData(GL_ELEMENT_ARRAY_BUFFER, len(indices) * SIZE_IN_BYTES, indices, GL_STATIC_DRAW)
 
+    # The attributes are read from the VBO with this layout, the VAO remembers it for every draw
+    gpuShape.layout = vertexLayout(shape) if layout is None else layout
+    stride = layoutStride(gpuShape.layout) * SIZE_IN_BYTES
+    offset = 0
+    for location, size in gpuShape.layout:
+        glVertexAttribPointer(location, size, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(offset))
+        glEnableVertexAttribArray(location)
+        offset += size * SIZE_IN_BYTES
+
+    # Bounds for culling and levels of detail, measured once here
+    if len(vertexData) > 0:
+        gpuShape.center, gpuShape.radius = bs.boundingSphere(vertexData, layoutStride(gpuShape.layout))
+
     if shape.textureFileName != None:
         assert wrapMode != None and filterMode != None
         
-        gpuShape.texture = glGenTextures(1)
-        textureSimpleSetup(gpuShape.texture, shape.textureFileName, wrapMode, filterMode)
+        gpuShape.texture = acquireTexture(shape.textureFileName, wrapMode, filterMode, mipmap)
 
     return gpuShape
 
 
-class SimpleShaderProgram:
+def deleteGPUShape(gpuShape):
+    # Frees the GPU memory referenced by the shape, its texture once no other shape shares it
+    gl_state.state.forget(gpuShape.vao, gpuShape.vbo, gpuShape.ebo)
+    glDeleteVertexArrays(1, [gpuShape.vao])
+    glDeleteBuffers(2, [gpuShape.vbo, gpuShape.ebo])
+    if gpuShape.texture and releaseTexture(gpuShape.texture):
+        gl_state.state.forget(gpuShape.texture)
+        glDeleteTextures([gpuShape.texture])
+
+    gpuShape.vao = gpuShape.vbo = gpuShape.ebo = gpuShape.texture = 0
+    gpuShape.size = 0
+
+
+class SimpleShaderProgram(ShaderProgram):
 
     def __init__(self):
 
@@ -116,33 +445,21 @@ class SimpleShaderProgram:
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
 
     def drawShape(self, shape, mode=GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-
-        # 3d vertices + rgb color specification => 3*4 + 3*4 = 24 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-        
-        color = glGetAttribLocation(self.shaderProgram, "color")
-        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleTextureShaderProgram:
+class SimpleTextureShaderProgram(ShaderProgram):
 
     def __init__(self):
 
@@ -176,34 +493,22 @@ class SimpleTextureShaderProgram:
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
 
     def drawShape(self, shape, mode=GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-        glBindTexture(GL_TEXTURE_2D, shape.texture)
-
-        # 3d vertices + 2d texture coordinates => 3*4 + 2*4 = 20 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-        
-        texCoords = glGetAttribLocation(self.shaderProgram, "texCoords")
-        glVertexAttribPointer(texCoords, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(texCoords)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+        gl_state.state.bindTexture(GL_TEXTURE_2D, shape.texture)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleTransformShaderProgram:
+class SimpleTransformShaderProgram(ShaderProgram):
 
     def __init__(self):
 
@@ -236,33 +541,21 @@ class SimpleTransformShaderProgram:
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
 
     def drawShape(self, shape, mode=GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-
-        # 3d vertices + rgb color specification => 3*4 + 3*4 = 24 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-        
-        color = glGetAttribLocation(self.shaderProgram, "color")
-        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleTextureTransformShaderProgram:
+class SimpleTextureTransformShaderProgram(ShaderProgram):
 
     def __init__(self):
 
@@ -298,34 +591,22 @@ class SimpleTextureTransformShaderProgram:
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
 
     def drawShape(self, shape, mode=GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-        glBindTexture(GL_TEXTURE_2D, shape.texture)
-
-        # 3d vertices + 2d texture coordinates => 3*4 + 2*4 = 20 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-        
-        texCoords = glGetAttribLocation(self.shaderProgram, "texCoords")
-        glVertexAttribPointer(texCoords, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(texCoords)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+        gl_state.state.bindTexture(GL_TEXTURE_2D, shape.texture)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleModelViewProjectionShaderProgram:
+class SimpleModelViewProjectionShaderProgram(ShaderProgram):
 
     def __init__(self):
 
@@ -358,33 +639,21 @@ class SimpleModelViewProjectionShaderProgram:
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
 
     def drawShape(self, shape, mode=GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-
-        # 3d vertices + rgb color specification => 3*4 + 3*4 = 24 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-        
-        color = glGetAttribLocation(self.shaderProgram, "color")
-        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleTextureModelViewProjectionShaderProgram:
+class SimpleTextureModelViewProjectionShaderProgram(ShaderProgram):
 
     def __init__(self):
 
@@ -422,28 +691,16 @@ class SimpleTextureModelViewProjectionShaderProgram:
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
 
     def drawShape(self, shape, mode=GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-        glBindTexture(GL_TEXTURE_2D, shape.texture)
-
-        # 3d vertices + 2d texture coordinates => 3*4 + 2*4 = 20 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-        
-        texCoords = glGetAttribLocation(self.shaderProgram, "texCoords")
-        glVertexAttribPointer(texCoords, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(texCoords)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+        gl_state.state.bindTexture(GL_TEXTURE_2D, shape.texture)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
@@ -0,0 +1,116 @@
+"""
+F. Urrutia V., CC3501, 2020-1
+-----------> GL STATE <-----------
+Seguimiento del estado de OpenGL:
+-GLState: programa, VAO, buffers, texturas y uniforms actuales
+-state: instancia global
+Las llamadas que no cambian el estado no llegan a OpenGL
+"""
+
+from OpenGL.GL import *
+import numpy as np
+
+
+class GLState(object):
+    # Remembers what is bound and the last value of every uniform, so redundant calls are skipped.
+    # Every bind of the libs goes through the global instance, a raw glBind* elsewhere makes it stale
+    # (call invalidate() after one).
+
+    def __init__(self):
+        self.program = None
+        self.vao = None
+        # target -> buffer; the element array buffer belongs to the bound VAO, it is keyed by (target, vao)
+        self.buffers = {}
+        # (target, index) -> (buffer, offset, size)
+        self.ranges = {}
+        # target -> texture (texture unit 0)
+        self.textures = {}
+        # (program, location) -> last value
+        self.uniforms = {}
+
+        # calls issued and skipped since the last endFrame()
+        self.issued = 0
+        self.elided = 0
+
+    def _changed(self, changed):
+        if changed:
+            self.issued += 1
+        else:
+            self.elided += 1
+        return changed
+
+    def useProgram(self, program):
+        if self._changed(self.program != program):
+            self.program = program
+            glUseProgram(program)
+
+    def bindVertexArray(self, vao):
+        if self._changed(self.vao != vao):
+            self.vao = vao
+            glBindVertexArray(vao)
+
+    def bindBuffer(self, target, buffer):
+        key = (target, self.vao) if target == GL_ELEMENT_ARRAY_BUFFER else target
+        if self._changed(self.buffers.get(key) != buffer):
+            self.buffers[key] = buffer
+            glBindBuffer(target, buffer)
+
+    def bindBufferRange(self, target, index, buffer, offset, size):
+        # glBindBufferRange also binds the buffer to target itself
+        if self._changed(self.ranges.get((target, index)) != (buffer, offset, size)):
+            self.ranges[(target, index)] = (buffer, offset, size)
+            self.buffers[target] = buffer
+            glBindBufferRange(target, index, buffer, offset, size)
+
+    def bindTexture(self, target, texture):
+        if self._changed(self.textures.get(target) != texture):
+            self.textures[target] = texture
+            glBindTexture(target, texture)
+
+    def uniform(self, program, location, value):
+        # True when value differs from the last one given to this location of program (the current one).
+        # Unknown locations (-1) are ignored by OpenGL, they are always skipped here
+        if location == -1:
+            self.elided += 1
+            return False
+        key = (program, location)
+        if self._changed(self.uniforms.get(key) != value):
+            self.uniforms[key] = value
+            return True
+        return False
+
+    def uniformMatrix(self, program, location, matrix):
+        # Matrices are compared by content, a copy of the bytes is kept
+        return self.uniform(program, location, np.asarray(matrix, dtype=np.float32).tobytes())
+
+    def forget(self, *names):
+        # Objects deleted from OpenGL: their names may be reused, so bindings to them are unknown from now on
+        names = set(names)
+        if self.vao in names:
+            self.vao = None
+        for key, buffer in list(self.buffers.items()):
+            if buffer in names or (isinstance(key, tuple) and key[1] in names):
+                del self.buffers[key]
+        for key, (buffer, offset, size) in list(self.ranges.items()):
+            if buffer in names:
+                del self.ranges[key]
+        for key, texture in list(self.textures.items()):
+            if texture in names:
+                del self.textures[key]
+
+    def invalidate(self):
+        # Nothing is assumed about the GL state after this, uniform values are kept (they live in the programs)
+        self.program = None
+        self.vao = None
+        self.buffers.clear()
+        self.ranges.clear()
+        self.textures.clear()
+
+    def endFrame(self):
+        # Returns (issued, elided) for the frame that just ended
+        counts = self.issued, self.elided
+        self.issued = self.elided = 0
+        return counts
+
+
+state = GLState()
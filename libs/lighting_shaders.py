@@ -9,14 +9,24 @@ F. Urrutia V.
 update Lighting Shaders
 
 v2.2: More light with PhongShader; color and texture
+v2.3: Instanced PhongShader (multi light)
+v2.4: Lights and materials of the multi light shaders in uniform blocks (std140)
+v2.5: Linked multi light programs are cached on disk (program binaries)
+v2.6: ShaderVariants, light count variants compiled on demand
+v2.7: Binds go through gl_state, redundant ones are skipped
+v2.8: Fixed attribute locations, drawShape only binds the VAO (layout set by toGPUShape)
+v2.9: Segments and SimplePhongShaderProgramMultiSegments, instances interpolated in the vertex shader
 """
 
 from OpenGL.GL import *
 import OpenGL.GL.shaders
-from libs.easy_shaders import GPUShape
+import weakref
+import numpy as np
+from libs.easy_shaders import GPUShape, ShaderProgram, linkProgram, cachedProgram
+from libs import gl_state
 
 
-class SimpleFlatShaderProgram():
+class SimpleFlatShaderProgram(ShaderProgram):
 
     def __init__(self):
         vertex_shader = """
@@ -89,36 +99,20 @@ class SimpleFlatShaderProgram():
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
     def drawShape(self, shape, mode = GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-
-        # 3d vertices + rgb color + 3d normals => 3*4 + 3*4 + 3*4 = 36 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-
-        color = glGetAttribLocation(self.shaderProgram, "color")
-        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
-
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(24))
-        glEnableVertexAttribArray(normal)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleTextureFlatShaderProgram():
+class SimpleTextureFlatShaderProgram(ShaderProgram):
 
     def __init__(self):
         vertex_shader = """
@@ -198,37 +192,21 @@ class SimpleTextureFlatShaderProgram():
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
     def drawShape(self, shape, mode = GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-        glBindTexture(GL_TEXTURE_2D, shape.texture)
-
-        # 3d vertices + rgb color + 3d normals => 3*4 + 2*4 + 3*4 = 32 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-
-        color = glGetAttribLocation(self.shaderProgram, "texCoords")
-        glVertexAttribPointer(color, 2, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
-
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(20))
-        glEnableVertexAttribArray(normal)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+        gl_state.state.bindTexture(GL_TEXTURE_2D, shape.texture)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleGouraudShaderProgram():
+class SimpleGouraudShaderProgram(ShaderProgram):
 
     def __init__(self):
         vertex_shader = """
@@ -301,36 +279,20 @@ class SimpleGouraudShaderProgram():
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
     def drawShape(self, shape, mode = GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-
-        # 3d vertices + rgb color + 3d normals => 3*4 + 3*4 + 3*4 = 36 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-
-        color = glGetAttribLocation(self.shaderProgram, "color")
-        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
-
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(24))
-        glEnableVertexAttribArray(normal)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleTextureGouraudShaderProgram():
+class SimpleTextureGouraudShaderProgram(ShaderProgram):
 
     def __init__(self):
         vertex_shader = """
@@ -410,37 +372,21 @@ class SimpleTextureGouraudShaderProgram():
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
     def drawShape(self, shape, mode = GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-        glBindTexture(GL_TEXTURE_2D, shape.texture)
-
-        # 3d vertices + rgb color + 3d normals => 3*4 + 2*4 + 3*4 = 32 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-
-        color = glGetAttribLocation(self.shaderProgram, "texCoords")
-        glVertexAttribPointer(color, 2, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
-
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(20))
-        glEnableVertexAttribArray(normal)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+        gl_state.state.bindTexture(GL_TEXTURE_2D, shape.texture)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimplePhongShaderProgram:
+class SimplePhongShaderProgram(ShaderProgram):
 
     def __init__(self):
         vertex_shader = """
@@ -520,36 +466,20 @@ class SimplePhongShaderProgram:
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
     def drawShape(self, shape, mode = GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-
-        # 3d vertices + rgb color + 3d normals => 3*4 + 3*4 + 3*4 = 36 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-
-        color = glGetAttribLocation(self.shaderProgram, "color")
-        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
-
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(24))
-        glEnableVertexAttribArray(normal)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleTexturePhongShaderProgram:
+class SimpleTexturePhongShaderProgram(ShaderProgram):
 
     def __init__(self):
         vertex_shader = """
@@ -633,38 +563,162 @@ class SimpleTexturePhongShaderProgram:
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = linkProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
 
     def drawShape(self, shape, mode = GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-        glBindTexture(GL_TEXTURE_2D, shape.texture)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+        gl_state.state.bindTexture(GL_TEXTURE_2D, shape.texture)
 
-        # 3d vertices + 2d texture coordinates + 3d normals => 3*4 + 2*4 + 3*4 = 32 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
+        # Render the active element buffer with the active shader program
+        glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
-        texCoords = glGetAttribLocation(self.shaderProgram, "texCoords")
-        glVertexAttribPointer(texCoords, 2, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(texCoords)
 
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(20))
-        glEnableVertexAttribArray(normal)
+# Every multi light program declares the same blocks, so one buffer serves all of them
+MAX_LIGHTS = 7
+LIGHTS_BINDING = 0
+MATERIAL_BINDING = 1
+
+
+def multi_light_blocks_code():
+    # std140 layout, mirrored by LightsBlock:
+    # Lights: viewPosition (16 bytes) + MAX_LIGHTS * 64 bytes
+    # Material: MAX_LIGHTS * 48 bytes
+    return f"""
+        struct Light
+        {{
+            vec3 position;
+            float constantAttenuation;
+            vec3 La;
+            float linearAttenuation;
+            vec3 Ld;
+            float quadraticAttenuation;
+            vec3 Ls;
+        }};
+
+        struct MaterialData
+        {{
+            vec3 Ka;
+            uint shininess;
+            vec3 Kd;
+            vec3 Ks;
+        }};
+
+        layout (std140) uniform Lights
+        {{
+            vec3 viewPosition;
+            Light lights[{MAX_LIGHTS}];
+        }};
+
+        layout (std140) uniform Material
+        {{
+            MaterialData material[{MAX_LIGHTS}];
+        }};
+        """
 
-        # Render the active element buffer with the active shader program
-        glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
+
+def bindLightBlocks(shaderProgram):
+    for name, binding in [("Lights", LIGHTS_BINDING), ("Material", MATERIAL_BINDING)]:
+        index = glGetUniformBlockIndex(shaderProgram, name)
+        if index != GL_INVALID_INDEX:
+            glUniformBlockBinding(shaderProgram, index, binding)
+
+
+class LightsBlock:
+    # CPU copy of the Lights and Material blocks, stored in a single uniform buffer.
+    # Lights are numbered from 1, as in the shaders. Call upload() once per frame, then bind() before drawing.
+
+    LIGHTS_SIZE = 16 + MAX_LIGHTS * 64
+    MATERIAL_SIZE = MAX_LIGHTS * 48
+
+    def __init__(self):
+        # Material starts after the lights, at the first multiple of the alignment of the driver
+        # (never below 16 bytes, the std140 alignment of its members)
+        alignment = max(int(glGetIntegerv(GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT)), 16)
+        self.materialOffset = -(-self.LIGHTS_SIZE // alignment) * alignment
+
+        self.data = np.zeros((self.materialOffset + self.MATERIAL_SIZE) // 4, dtype=np.float32)
+        self.uint = self.data.view(np.uint32)
+        self.ubo = glGenBuffers(1)
+        gl_state.state.bindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+        glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+        gl_state.state.bindBuffer(GL_UNIFORM_BUFFER, 0)
+
+    def setViewPosition(self, x, y, z):
+        self.data[0:3] = x, y, z
+
+    def setLight(self, i, position=None, La=None, Ld=None, Ls=None, attenuation=None):
+        # attenuation: (constant, linear, quadratic)
+        base = 4 + 16 * (i - 1)
+        if position is not None:
+            self.data[base:base + 3] = position
+        if La is not None:
+            self.data[base + 4:base + 7] = La
+        if Ld is not None:
+            self.data[base + 8:base + 11] = Ld
+        if Ls is not None:
+            self.data[base + 12:base + 15] = Ls
+        if attenuation is not None:
+            self.data[[base + 3, base + 7, base + 11]] = attenuation
+
+    def setMaterial(self, i, Ka=None, Kd=None, Ks=None, shininess=None):
+        base = self.materialOffset // 4 + 12 * (i - 1)
+        if Ka is not None:
+            self.data[base:base + 3] = Ka
+        if shininess is not None:
+            # same wrap around as glUniform1ui, -1 is the largest exponent
+            self.uint[base + 3] = int(shininess) & 0xFFFFFFFF
+        if Kd is not None:
+            self.data[base + 4:base + 7] = Kd
+        if Ks is not None:
+            self.data[base + 8:base + 11] = Ks
+
+    def upload(self):
+        # A single buffer update for every light and material parameter
+        gl_state.state.bindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+        glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+        gl_state.state.bindBuffer(GL_UNIFORM_BUFFER, 0)
+
+    def bind(self):
+        gl_state.state.bindBufferRange(GL_UNIFORM_BUFFER, LIGHTS_BINDING, self.ubo, 0, self.LIGHTS_SIZE)
+        gl_state.state.bindBufferRange(GL_UNIFORM_BUFFER, MATERIAL_BINDING, self.ubo, self.materialOffset,
+                                       self.MATERIAL_SIZE)
+
+
+class ShaderVariants:
+    # Light count variants of a multi light shader, [i] is the program with 3 + i lights.
+    # A variant is compiled the first time it is requested, or ahead of time with compileNext().
+
+    def __init__(self, programClass, counts=range(3, MAX_LIGHTS + 1)):
+        self.programClass = programClass
+        self.counts = list(counts)
+        self.programs = [None] * len(self.counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, i):
+        if self.programs[i] is None:
+            self.programs[i] = self.programClass(self.counts[i])
+        return self.programs[i]
+
+    def compileNext(self, start=0):
+        # Compiles the first missing variant from start on (then from the beginning).
+        # Returns False when every variant was already compiled.
+        n = len(self.counts)
+        for j in range(n):
+            i = (start + j) % n
+            if self.programs[i] is None:
+                self[i]
+                return True
+        return False
 
 
 # SOLUTION
-class SimpleTexturePhongShaderProgramMulti:
+class SimpleTexturePhongShaderProgramMulti(ShaderProgram):
 
     def __init__(self, num):
         vertex_shader = """
@@ -694,37 +748,22 @@ class SimpleTexturePhongShaderProgramMulti:
 
         fragment_shader = dual_multi_fragment_shader_code(num, 'tx')
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = cachedProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
+        bindLightBlocks(self.shaderProgram)
 
     def drawShape(self, shape, mode = GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-        glBindTexture(GL_TEXTURE_2D, shape.texture)
-
-        # 3d vertices + 2d texture coordinates + 3d normals => 3*4 + 2*4 + 3*4 = 32 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-
-        texCoords = glGetAttribLocation(self.shaderProgram, "texCoords")
-        glVertexAttribPointer(texCoords, 2, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(texCoords)
-
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(20))
-        glEnableVertexAttribArray(normal)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+        gl_state.state.bindTexture(GL_TEXTURE_2D, shape.texture)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimplePhongShaderProgramMulti:
+class SimplePhongShaderProgramMulti(ShaderProgram):
 
     def __init__(self, num):
         vertex_shader = """
@@ -754,37 +793,217 @@ class SimplePhongShaderProgramMulti:
 
         fragment_shader = dual_multi_fragment_shader_code(num, 'col')
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = cachedProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
+        bindLightBlocks(self.shaderProgram)
 
     def drawShape(self, shape, mode = GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
 
-        # 3d vertices + rgb color + 3d normals => 3*4 + 3*4 + 3*4 = 36 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
+        # Render the active element buffer with the active shader program
+        glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
-        color = glGetAttribLocation(self.shaderProgram, "color")
-        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
 
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(24))
-        glEnableVertexAttribArray(normal)
+class SimplePhongShaderProgramMultiInstanced(ShaderProgram):
+    # Per-instance model matrices are streamed to a single buffer, shared by every light count variant:
+    # they draw the same shapes, whose VAO stays wired to it
+    instanceVbo = None
+    # Shapes whose VAO already reads its instance attributes from instanceVbo
+    instancedShapes = weakref.WeakSet()
 
-        # Render the active element buffer with the active shader program
-        glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
+    def __init__(self, num):
+        vertex_shader = """
+            #version 330 core
+
+            layout (location = 0) in vec3 position;
+            layout (location = 1) in vec3 color;
+            layout (location = 2) in vec3 normal;
+            layout (location = 3) in mat4 instanceModel;
+
+            out vec3 fragPosition;
+            out vec3 fragOriginalColor;
+            out vec3 fragNormal;
+
+            uniform mat4 model;
+            uniform mat4 view;
+            uniform mat4 projection;
+
+            void main()
+            {
+                // model is shared by every instance, instanceModel places each one
+                mat4 fullModel = instanceModel * model;
+                fragPosition = vec3(fullModel * vec4(position, 1.0));
+                fragOriginalColor = color;
+                fragNormal = mat3(transpose(inverse(fullModel))) * normal;
+
+                gl_Position = projection * view * vec4(fragPosition, 1.0);
+            }
+            """
+
+        fragment_shader = dual_multi_fragment_shader_code(num, 'col')
+
+        self.shaderProgram = cachedProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
+        bindLightBlocks(self.shaderProgram)
+
+        if SimplePhongShaderProgramMultiInstanced.instanceVbo is None:
+            SimplePhongShaderProgramMultiInstanced.instanceVbo = glGenBuffers(1)
+
+    def drawShapeInstanced(self, shape, models, mode=GL_TRIANGLES, columnMajor=False):
+        # columnMajor: models is already a float32 stack in the layout of the instance buffer
+        # (see transformations.translateRotZBatch), it is uploaded as is
+        assert isinstance(shape, GPUShape)
+
+        count = len(models)
+        if count == 0:
+            return
+
+        # transformations are row-major, GLSL matrices are read column by column
+        if columnMajor:
+            instanceData = np.ascontiguousarray(models, dtype=np.float32)
+        else:
+            instanceData = np.ascontiguousarray(np.transpose(np.asarray(models, dtype=np.float32), (0, 2, 1)))
+
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+
+        # mat4 per instance => 4 vec4 attributes, 4*4*4 = 64 bytes, advancing once per instance
+        gl_state.state.bindBuffer(GL_ARRAY_BUFFER, self.instanceVbo)
+        glBufferData(GL_ARRAY_BUFFER, instanceData.nbytes, instanceData, GL_STREAM_DRAW)
+        if shape not in self.instancedShapes:
+            # the VAO keeps reading this buffer, only its content changes afterwards
+            self.instancedShapes.add(shape)
+            instanceModel = self.attributes["instanceModel"]
+            for i in range(4):
+                glVertexAttribPointer(instanceModel + i, 4, GL_FLOAT, GL_FALSE, 64, ctypes.c_void_p(16 * i))
+                glEnableVertexAttribArray(instanceModel + i)
+                glVertexAttribDivisor(instanceModel + i, 1)
+
+        # Every instance is rendered with a single call
+        glDrawElementsInstanced(mode, shape.size, GL_UNSIGNED_INT, None, count)
+
+
+class Segments:
+    # Instances of SimplePhongShaderProgramMultiSegments. data is an (N, 2, 4) float32 array, per instance the
+    # texels (x0, y0, x1, y1) and (theta0, theta1, 0, 0); the instance is placed at translateRotZ of both ends
+    # mixed at progress. A new data array is uploaded once, progress is the only value sent every frame
+    def __init__(self, data, progress=0.0):
+        self.data = data
+        self.progress = progress
+        self.sphere = None
+        self.sphereKey = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def bounds(self, shape, model):
+        # A sphere (center, radius) around every instance of shape at any progress, model being the matrix
+        # shared by the instances; None when shape has no bounds. Computed once per data and model
+        if shape.center is None or len(self.data) == 0:
+            return None
+        model = np.asarray(model, dtype=np.float32)
+        key = (shape, model.tobytes())
+        if self.sphereKey != key:
+            # the shape placed by model, then turned around z by each instance
+            center = np.matmul(model[0:3, 0:3], shape.center) + model[0:3, 3]
+            radius = shape.radius * float(np.linalg.norm(model[0:3, 0:3], axis=0).max())
+            turn = float(np.linalg.norm(center[0:2]))
+            # every position lies on a segment between two ends
+            ends = self.data[:, 0, :].reshape(-1, 2)
+            middle = (ends.min(axis=0) + ends.max(axis=0)) / 2
+            reach = float(np.linalg.norm(ends - middle, axis=1).max())
+            self.sphere = np.array([middle[0], middle[1], center[2]], dtype=np.float32), reach + turn + radius
+            self.sphereKey = key
+        return self.sphere
+
+
+class SimplePhongShaderProgramMultiSegments(ShaderProgram):
+
+    def __init__(self, num):
+        vertex_shader = """
+            #version 330 core
+
+            layout (location = 0) in vec3 position;
+            layout (location = 1) in vec3 color;
+            layout (location = 2) in vec3 normal;
+
+            out vec3 fragPosition;
+            out vec3 fragOriginalColor;
+            out vec3 fragNormal;
+
+            uniform mat4 model;
+            uniform mat4 view;
+            uniform mat4 projection;
+
+            // 2 texels per instance: both ends of its segment and both angles
+            uniform samplerBuffer segments;
+            uniform float progress;
+
+            void main()
+            {
+                vec4 ends = texelFetch(segments, 2 * gl_InstanceID);
+                vec2 angles = texelFetch(segments, 2 * gl_InstanceID + 1).xy;
+                vec2 pos = mix(ends.xy, ends.zw, progress);
+                float theta = mix(angles.x, angles.y, progress);
+
+                // translateRotZ(pos.x, pos.y, 0, theta), column by column
+                float c = cos(theta);
+                float s = sin(theta);
+                mat4 instanceModel = mat4(c, s, 0, 0, -s, c, 0, 0, 0, 0, 1, 0, pos.x, pos.y, 0, 1);
+
+                mat4 fullModel = instanceModel * model;
+                fragPosition = vec3(fullModel * vec4(position, 1.0));
+                fragOriginalColor = color;
+                fragNormal = mat3(transpose(inverse(fullModel))) * normal;
+
+                gl_Position = projection * view * vec4(fragPosition, 1.0);
+            }
+            """
+
+        fragment_shader = dual_multi_fragment_shader_code(num, 'col')
+
+        self.shaderProgram = cachedProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
+        bindLightBlocks(self.shaderProgram)
+
+        # Segment data lives in a buffer, read through a texture (texture unit 0)
+        self.segmentVbo = glGenBuffers(1)
+        self.segmentTexture = glGenTextures(1)
+        # a name becomes a buffer object when first bound, glTexBuffer needs one
+        gl_state.state.bindBuffer(GL_TEXTURE_BUFFER, self.segmentVbo)
+        gl_state.state.bindTexture(GL_TEXTURE_BUFFER, self.segmentTexture)
+        glTexBuffer(GL_TEXTURE_BUFFER, GL_RGBA32F, self.segmentVbo)
+        # data of the last Segments uploaded
+        self.uploaded = None
+
+    def drawShapeInstanced(self, shape, segments, mode=GL_TRIANGLES, columnMajor=False):
+        # segments: Segments; columnMajor is not used, the signature is the one of the instanced programs
+        assert isinstance(shape, GPUShape)
+
+        count = len(segments)
+        if count == 0:
+            return
+
+        if segments.data is not self.uploaded:
+            self.uploaded = segments.data
+            data = np.ascontiguousarray(segments.data, dtype=np.float32)
+            gl_state.state.bindBuffer(GL_TEXTURE_BUFFER, self.segmentVbo)
+            glBufferData(GL_TEXTURE_BUFFER, data.nbytes, data, GL_DYNAMIC_DRAW)
+        self.uniform1f("progress", segments.progress)
+
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+        gl_state.state.bindTexture(GL_TEXTURE_BUFFER, self.segmentTexture)
+
+        # Every instance is rendered with a single call
+        glDrawElementsInstanced(mode, shape.size, GL_UNSIGNED_INT, None, count)
 
 
 def dual_multi_fragment_shader_code(size, mod='col'):
-    assert type(size) == int and size > 1, """ Error size: int and >1"""
+    assert type(size) == int and 1 < size <= MAX_LIGHTS, """ Error size: int, >1 and <=MAX_LIGHTS"""
     assert mod in ['col', 'tx'], """ Error mod: col or tx"""
 
     dict = {'col': ['in vec3 fragOriginalColor;', '', '' , ''],
@@ -799,24 +1018,7 @@ def dual_multi_fragment_shader_code(size, mod='col'):
         """ + dict[mod][0] + """
 
         out vec4 fragColor;
-
-        uniform vec3 viewPosition;
-    """
-    for i in range(1, size + 1):
-        code += f"""
-        uniform vec3 lightPosition{i};
-        uniform vec3 La{i};
-        uniform vec3 Ld{i};
-        uniform vec3 Ls{i};
-        uniform vec3 Ka{i};
-        uniform vec3 Kd{i};
-        uniform vec3 Ks{i};
-        uniform uint shininess{i};
-        uniform float constantAttenuation{i};
-        uniform float linearAttenuation{i};
-        uniform float quadraticAttenuation{i};
-        """
-    code += """
+        """ + multi_light_blocks_code() + """
         """ + dict[mod][1] + """
 
         void main()
@@ -825,7 +1027,7 @@ def dual_multi_fragment_shader_code(size, mod='col'):
         """
     for i in range(1, size + 1):
         code += f"""
-            vec3 ambient{i} = Ka{i} * La{i};
+            vec3 ambient{i} = material[{i - 1}].Ka * lights[{i - 1}].La;
         """
     code += """
             // diffuse
@@ -834,10 +1036,10 @@ def dual_multi_fragment_shader_code(size, mod='col'):
         """
     for i in range(1, size + 1):
         code += f"""
-            vec3 toLight{i} = lightPosition{i} - fragPosition;
+            vec3 toLight{i} = lights[{i - 1}].position - fragPosition;
             vec3 lightDir{i} = normalize(toLight{i});
             float diff{i} = max(dot(normalizedNormal, lightDir{i}), 0.0);
-            vec3 diffuse{i} = Kd{i} * Ld{i} * diff{i};
+            vec3 diffuse{i} = material[{i - 1}].Kd * lights[{i - 1}].Ld * diff{i};
         """
     code += """
             // specular
@@ -846,8 +1048,8 @@ def dual_multi_fragment_shader_code(size, mod='col'):
     for i in range(1, size + 1):
         code += f"""
             vec3 reflectDir{i} = reflect(-lightDir{i}, normalizedNormal);  
-            float spec{i} = pow(max(dot(viewDir, reflectDir{i}), 0.0), shininess{i});
-            vec3 specular{i} = Ks{i} * Ls{i} * spec{i};
+            float spec{i} = pow(max(dot(viewDir, reflectDir{i}), 0.0), material[{i - 1}].shininess);
+            vec3 specular{i} = material[{i - 1}].Ks * lights[{i - 1}].Ls * spec{i};
         """
     code += """
             // attenuation
@@ -855,9 +1057,9 @@ def dual_multi_fragment_shader_code(size, mod='col'):
     for i in range(1, size + 1):
         code += f"""
             float distToLight{i} = length(toLight{i});
-            float attenuation{i} = constantAttenuation{i}
-                + linearAttenuation{i} * distToLight{i}
-                + quadraticAttenuation{i} * distToLight{i} * distToLight{i};
+            float attenuation{i} = lights[{i - 1}].constantAttenuation
+                + lights[{i - 1}].linearAttenuation * distToLight{i}
+                + lights[{i - 1}].quadraticAttenuation * distToLight{i} * distToLight{i};
             """
     line = ""
     for i in range(1, size + 1):
@@ -873,7 +1075,7 @@ def dual_multi_fragment_shader_code(size, mod='col'):
     return code
 
 
-class SimpleGouraudShaderProgramMulti:
+class SimpleGouraudShaderProgramMulti(ShaderProgram):
 
     def __init__(self, num):
         vertex_shader = dual_multi_vertex_shader_code(num, 'col')
@@ -890,36 +1092,21 @@ class SimpleGouraudShaderProgramMulti:
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = cachedProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
+        bindLightBlocks(self.shaderProgram)
 
     def drawShape(self, shape, mode=GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-
-        # 3d vertices + rgb color + 3d normals => 3*4 + 3*4 + 3*4 = 36 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-
-        color = glGetAttribLocation(self.shaderProgram, "color")
-        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
-
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(24))
-        glEnableVertexAttribArray(normal)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
-class SimpleTextureGouraudShaderProgramMulti():
+class SimpleTextureGouraudShaderProgramMulti(ShaderProgram):
 
     def __init__(self, num):
         vertex_shader = dual_multi_vertex_shader_code(num, 'tx')
@@ -941,38 +1128,23 @@ class SimpleTextureGouraudShaderProgramMulti():
             }
             """
 
-        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
-            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
-            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+        self.shaderProgram = cachedProgram(vertex_shader, fragment_shader)
+        self.setupLocations()
+        bindLightBlocks(self.shaderProgram)
 
     def drawShape(self, shape, mode=GL_TRIANGLES):
         assert isinstance(shape, GPUShape)
 
-        # Binding the proper buffers
-        glBindVertexArray(shape.vao)
-        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
-        glBindTexture(GL_TEXTURE_2D, shape.texture)
-
-        # 3d vertices + rgb color + 3d normals => 3*4 + 2*4 + 3*4 = 32 bytes
-        position = glGetAttribLocation(self.shaderProgram, "position")
-        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(position)
-
-        color = glGetAttribLocation(self.shaderProgram, "texCoords")
-        glVertexAttribPointer(color, 2, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(color)
-
-        normal = glGetAttribLocation(self.shaderProgram, "normal")
-        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 32, ctypes.c_void_p(20))
-        glEnableVertexAttribArray(normal)
+        # The vertex layout was set in the VAO once, by toGPUShape
+        gl_state.state.bindVertexArray(shape.vao)
+        gl_state.state.bindTexture(GL_TEXTURE_2D, shape.texture)
 
         # Render the active element buffer with the active shader program
         glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
 
 
 def dual_multi_vertex_shader_code(size, mod='col'):
-    assert type(size) == int and size > 1, """ Error size: int and >1"""
+    assert type(size) == int and 1 < size <= MAX_LIGHTS, """ Error size: int, >1 and <=MAX_LIGHTS"""
     assert mod in ['col', 'tx'], """ Error mod: col or tx"""
 
     dict = {'col': ['in vec3 color;', 'out vec4 vertexColor;', '', 'vec3 result', '* color',
@@ -993,24 +1165,7 @@ def dual_multi_vertex_shader_code(size, mod='col'):
         uniform mat4 model;
         uniform mat4 view;
         uniform mat4 projection;
-        
-        uniform vec3 viewPosition;
-    """
-    for i in range(1, size + 1):
-        code += f"""
-        uniform vec3 lightPosition{i};
-        uniform vec3 La{i};
-        uniform vec3 Ld{i};
-        uniform vec3 Ls{i};
-        uniform vec3 Ka{i};
-        uniform vec3 Kd{i};
-        uniform vec3 Ks{i};
-        uniform uint shininess{i};
-        uniform float constantAttenuation{i};
-        uniform float linearAttenuation{i};
-        uniform float quadraticAttenuation{i};
-        """
-    code += """
+        """ + multi_light_blocks_code() + """
     
         void main()
         {
@@ -1021,7 +1176,7 @@ def dual_multi_vertex_shader_code(size, mod='col'):
         """
     for i in range(1, size + 1):
         code += f"""
-            vec3 ambient{i} = Ka{i} * La{i};
+            vec3 ambient{i} = material[{i - 1}].Ka * lights[{i - 1}].La;
         """
     code += """
             // diffuse
@@ -1029,10 +1184,10 @@ def dual_multi_vertex_shader_code(size, mod='col'):
         """
     for i in range(1, size + 1):
         code += f"""
-            vec3 toLight{i} = lightPosition{i} - vertexPos;
+            vec3 toLight{i} = lights[{i - 1}].position - vertexPos;
             vec3 lightDir{i} = normalize(toLight{i});
             float diff{i} = max(dot(norm, lightDir{i}), 0.0);
-            vec3 diffuse{i} = Kd{i} * Ld{i} * diff{i};
+            vec3 diffuse{i} = material[{i - 1}].Kd * lights[{i - 1}].Ld * diff{i};
         """
     code += """
             // specular
@@ -1041,8 +1196,8 @@ def dual_multi_vertex_shader_code(size, mod='col'):
     for i in range(1, size + 1):
         code += f"""
             vec3 reflectDir{i} = reflect(-lightDir{i}, norm);  
-            float spec{i} = pow(max(dot(viewDir, reflectDir{i}), 0.0), shininess{i});
-            vec3 specular{i} = Ks{i} * Ls{i} * spec{i};
+            float spec{i} = pow(max(dot(viewDir, reflectDir{i}), 0.0), material[{i - 1}].shininess);
+            vec3 specular{i} = material[{i - 1}].Ks * lights[{i - 1}].Ls * spec{i};
         """
     code += """
             // attenuation
@@ -1050,9 +1205,9 @@ def dual_multi_vertex_shader_code(size, mod='col'):
     for i in range(1, size + 1):
         code += f"""
             float distToLight{i} = length(toLight{i});
-            float attenuation{i} = constantAttenuation{i}
-                + linearAttenuation{i} * distToLight{i}
-                + quadraticAttenuation{i} * distToLight{i} * distToLight{i};
+            float attenuation{i} = lights[{i - 1}].constantAttenuation
+                + lights[{i - 1}].linearAttenuation * distToLight{i}
+                + lights[{i - 1}].quadraticAttenuation * distToLight{i} * distToLight{i};
             """
     line = ""
     for i in range(1, size + 1):
@@ -15,15 +15,59 @@ Modelos:
 -funciones:
 --get_pos:  interpolacion posiciones
 --get_theta       ""      angulos
+--get_pos_batch, get_theta_batch: lo mismo para arreglos de celdas
+--get_theta_end: angulo final de un giro (para interpolar en la GPU)
 """
 
 from libs import basic_shapes as bs, transformations as tr, easy_shaders as es, scene_graph as sg, \
-    lighting_shaders as ls
+    lighting_shaders as ls, assets as am, render_queue as rq
 import numpy as np
 from OpenGL.GL import *
 import random as rd
 from typing import Union
 
+# Meshes used by the models, also read by the preload stage (view.py)
+MESHES = {
+    'head': dict(filename='libs/obj/head.obj', color=(0.4, 1, 0.4), status=False),
+    'eyes': dict(filename='libs/obj/eyes.obj', color=(1, 0.2, 0.2), status=False),
+    'teeth': dict(filename='libs/obj/teeth.obj', color=(0.8, .8, .8), status=False),
+    'body': dict(filename='libs/obj/body.obj', color=(0.4, 1, 0.4), status=False),
+    'food': dict(filename='libs/obj/lightBulb.obj', color=(1, 0.1, 0.1), weld=True),
+    'lamp': dict(filename='libs/obj/streetLamp.obj', color=(0.2, 0.2, 0.2), weld=True),
+    'arc': dict(filename='libs/obj/ancient_wall.obj', color=(1, 1, 0.72), status=False, weld=True),
+}
+
+# Constant placement of the OBJ meshes of the snake, folded once
+HEAD_SHAPE = tr.freeze([
+    tr.uniformScale(0.9),
+    tr.rotationZ(np.pi / 2),
+    tr.rotationX(np.pi / 2),
+    tr.uniformScale(0.01),
+    tr.translate(0, 0, 0)])
+BODY_SHAPE = tr.freeze([
+    tr.uniformScale(0.8),
+    tr.rotationZ(np.pi / 2),
+    tr.rotationX(np.pi / 2),
+    tr.uniformScale(0.01),
+    tr.translate(0, 0, 0)])
+
+# Meshes drawn with levels of detail (see scene_graph.LODNode)
+LOD_MESHES = ['food', 'lamp', 'arc']
+
+
+# Pieces along each wall of the background, culled one by one
+WALL_CHUNKS = 4
+
+# Lamps at the corners of the map, lights 4 to 7 of the multi light shaders
+LAMPS = {1: (1, 1), 2: (-1, 1), 3: (1, -1), 4: (-1, -1)}
+
+
+def preload_meshes():
+    meshes = list(MESHES.values())
+    for name in LOD_MESHES:
+        meshes += [dict(MESHES[name], lod=lod) for lod in am.LOD_RESOLUTIONS]
+    return meshes
+
 
 class Game(object):
     def __init__(self, n):
@@ -100,6 +144,8 @@ class Snake(object):
         self.next = tuple(sum(t) for t in zip(self.pos, self.dir))
         self.tail = []
         self.tail_angle = []
+        # ls.Segments of the body, rebuilt after each change of the tail or the angles
+        self.segments = None
         self.angle = {
             (0, 0): np.pi / 2,
             (-1, 0): np.pi / 2,
@@ -113,35 +159,22 @@ class Snake(object):
         # time
         self.t0 = 0
 
-        gpu_head_quad = es.toGPUShape(bs.readOBJ('libs/obj/head.obj', (0.4, 1, 0.4), status=False))
-        gpu_eyes_quad = es.toGPUShape(bs.readOBJ('libs/obj/eyes.obj', (1, 0.2, 0.2), status=False))
-        gpu_teeth_quad = es.toGPUShape(bs.readOBJ('libs/obj/teeth.obj', (0.8, .8, .8), status=False))
+        gpu_head_quad = am.registry.acquireOBJ(**MESHES['head'])
+        gpu_eyes_quad = am.registry.acquireOBJ(**MESHES['eyes'])
+        gpu_teeth_quad = am.registry.acquireOBJ(**MESHES['teeth'])
+        # body pieces share this mesh, it is loaded here so eating never reads body.obj
+        self.gpu_body_quad = am.registry.acquireOBJ(**MESHES['body'])
 
         head = sg.SceneGraphNode('head')
-        head.transform = tr.matmul([
-            tr.uniformScale(0.9),
-            tr.rotationZ(np.pi / 2),
-            tr.rotationX(np.pi / 2),
-            tr.uniformScale(0.01),
-            tr.translate(0, 0, 0)])
+        head.transform = HEAD_SHAPE
         head.childs += [gpu_head_quad]
 
         eyes = sg.SceneGraphNode('eyes')
-        eyes.transform = tr.matmul([
-            tr.uniformScale(0.9),
-            tr.rotationZ(np.pi / 2),
-            tr.rotationX(np.pi / 2),
-            tr.uniformScale(0.01),
-            tr.translate(0, 0, 0)])
+        eyes.transform = HEAD_SHAPE
         eyes.childs += [gpu_eyes_quad]
 
         teeth = sg.SceneGraphNode('teeth')
-        teeth.transform = tr.matmul([
-            tr.uniformScale(0.9),
-            tr.rotationZ(np.pi / 2),
-            tr.rotationX(np.pi / 2),
-            tr.uniformScale(0.01),
-            tr.translate(0, 0, 0)])
+        teeth.transform = HEAD_SHAPE
         teeth.childs += [gpu_teeth_quad]
 
         head_tr = sg.SceneGraphNode('head_tr')
@@ -161,144 +194,99 @@ class Snake(object):
         self.head = head_tr
         self.bodySnake = bodySnake(self)
 
+        # White light in all components: ambient, diffuse and specular.
+        # Object is barely visible at only ambient. Bright white for diffuse and specular components.
+        # Only the positions of the snake and food lights change between frames
+        self.lights = ls.LightsBlock()
+        self.lights.setLight(1, position=(0, 0, 1.5), La=(0.8, 0.2, 0.0), Ld=(1.0, 1.0, 1.0), Ls=(1.0, 1.0, 1.0),
+                             attenuation=(-1.93, 2.04, 1.78))
+        self.lights.setLight(2, La=(1.0, 1.0, 1.0), Ld=(1.0, 1.0, 1.0), Ls=(1.0, 1.0, 1.0),
+                             attenuation=(0.78, 3.3, 0))
+        self.lights.setLight(3, La=(1.0, 1.0, 1.0), Ld=(1, 0.01, 0.01), Ls=(1.0, 0.3, 0.3),
+                             attenuation=(0.78, 3.3, 0))
+        self.lights.setMaterial(1, Ka=(0.008, 0.008, 0.008), Kd=(0.5, 0.5, 0.5), Ks=(0, 0, 0), shininess=-1)
+        self.lights.setMaterial(2, Ka=(0, 0, 0), Kd=(0.7, 1.0, 0.7), Ks=(0.5, 0.5, 0.5), shininess=100)
+        self.lights.setMaterial(3, Ka=(-0.04, -0.04, -0.04), Kd=(1.0, 0.7, 0.7), Ks=(0.36, 0.36, 0.36), shininess=100)
+        for j, lamp in LAMPS.items():
+            self.lights.setLight(3 + j, position=(0.9 * lamp[0], 0.9 * lamp[1], 0.14), La=(1.0, 1.0, 1.0),
+                                 Ld=(1, 1, 1), Ls=(1.0, 1.0, 1.0), attenuation=(0.63, 0.59, 4))
+            self.lights.setMaterial(3 + j, Ka=(-0.04, -0.04, -0.04), Kd=(0.95, 1.0, 1.0), Ks=(1, 1, 1),
+                                    shininess=100)
+
         self.g_grid = self.game.grid
         self.g_size = self.game.size
         self.g_center = self.game.center
 
-    def draw(self, pipeline, projection, view, size):
+    def draw(self, queue, pipeline, size, pipeline_inst=None, pipeline_seg=None):
+        # pipeline_inst: the body in one instanced call; pipeline_seg: the same, interpolated in the vertex shader
         view_pos = get_pos(self.g_grid, self.g_size, self.pos, self.next,
                            self.current_pos, i=self.game.count, m=self.game.time / self.game.dt)
         theta = get_theta(self.theta, self.new_theta, i=self.game.count - self.t0,
                           m=self.game.time / self.game.dt - self.t0)
         self.game.view_pos = view_pos
         self.game.cam_angle = theta
-        self.head.transform = tr.matmul([
-            tr.translate(
-                tx=view_pos[0],
-                ty=view_pos[1],
-                tz=0
-            ),
-            tr.rotationZ(theta)
-        ])
-
-        glUseProgram(pipeline.shaderProgram)
-        dict = {'H': self.head, 'B': self.body}
-        for k in ['H', 'B']:
-            model = dict[k]
-
-            # White light in all components: ambient, diffuse and specular.
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La1"), 0.8, 0.2, 0.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld1"), 1.0, 1.0, 1.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls1"), 1.0, 1.0, 1.0)
-
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La2"), 1.0, 1.0, 1.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld2"), 1.0, 1.0, 1.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls2"), 1.0, 1.0, 1.0)
-
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La3"), 1.0, 1.0, 1.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld3"), 1, 0.01, 0.01)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls3"), 1.0, 0.3, 0.3)
-
-            # Object is barely visible at only ambient. Bright white for diffuse and specular components.
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka1"), 0.008, 0.008, 0.008)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd1"), 0.5, 0.5, 0.5)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks1"), 0, 0, 0)
-
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka2"), 0, 0, 0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd2"), 0.7, 1.0, 0.7)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks2"), 0.5, 0.5, 0.5)
-
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka3"), -0.04, -0.04, -0.04)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd3"), 1.0, 0.7, 0.7)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks3"), 0.36, 0.36, 0.36)
-
-            # TO DO: Explore different parameter combinations to understand their effect!
-
-            viewPos = self.game.view_cam
-            snakePos = self.game.view_pos
-            foodPos = self.game.view_food
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition1"), 0, 0, 1.5)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition2"), snakePos[0], snakePos[1], 0.24)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition3"), foodPos[0], foodPos[1], 0.1)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "viewPosition"), viewPos[0], viewPos[1],
-                        viewPos[2])
-
-            glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess1"), -1)
-            glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess2"), 100)
-            glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess3"), 100)
-
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation1"), -1.93)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation1"), 2.04)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation1"), 1.78)
-
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation2"), 0.78)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation2"), 3.3)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation2"), 0)
+        # written in place, the node owns its matrix
+        self.head.transform = tr.translateRotZ(view_pos[0], view_pos[1], 0, theta, out=self.head.transform)
 
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation3"), 0.78)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation3"), 3.3)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation3"), 0)
-
-            lamps = {1: (1, 1), 2: (-1, 1), 3: (1, -1), 4: (-1, -1)}
-            for j in range(1, size + 1):
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"La{3 + j}"), 1.0, 1.0, 1.0)
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Ld{3 + j}"), 1, 1, 1)
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Ls{3 + j}"), 1.0, 1.0, 1.0)
-
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Ka{3 + j}"), -0.04, -0.04, -0.04)
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Kd{3 + j}"), 0.95, 1.0, 1.0)
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Ks{3 + j}"), 1, 1, 1)
-
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"lightPosition{3 + j}"),
-                            0.9 * lamps[j][0], 0.9 * lamps[j][1], 0.14)
-
-                glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, f"shininess{3 + j}"), 100)
-
-                glUniform1f(glGetUniformLocation(pipeline.shaderProgram, f"constantAttenuation{3 + j}"), 0.63)
-                glUniform1f(glGetUniformLocation(pipeline.shaderProgram, f"linearAttenuation{3 + j}"), 0.59)
-                glUniform1f(glGetUniformLocation(pipeline.shaderProgram, f"quadraticAttenuation{3 + j}"), 4)
+        viewPos = self.game.view_cam
+        snakePos = self.game.view_pos
+        foodPos = self.game.view_food
+        self.lights.setLight(2, position=(snakePos[0], snakePos[1], 0.24))
+        self.lights.setLight(3, position=(foodPos[0], foodPos[1], 0.1))
+        self.lights.setViewPosition(viewPos[0], viewPos[1], viewPos[2])
+        self.lights.upload()
 
-            glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
-            glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "view"), 1, GL_TRUE, view)
+        # with an instanced pipeline the whole body is drawn in a single call
+        dict = {'H': (pipeline, self.head), 'B': (pipeline if pipeline_inst is None else pipeline_inst, self.body)}
+        for k in ['H', 'B']:
+            pipeline, model = dict[k]
 
             if k =='H':
-                sg.drawSceneGraphNode(model, pipeline)
+                queue.submitNode(model, pipeline, self.lights)
+            elif pipeline_seg is not None:
+                # only the progress of the tick changes between frames, the segments are built once per tick
+                if self.segments is None:
+                    self.segments = self.tail_segments()
+                self.segments.progress = self.game.count / (self.game.time / self.game.dt)
+                if len(self.segments):
+                    body_sh = model.childs[0].childs[0]
+                    queue.submit(pipeline_seg, body_sh.childs[0], body_sh.transform, self.lights,
+                                 instances=self.segments)
             else:
-                length = len(self.tail)
-                for t in range(length):
-                    piece = model.childs[t]
-                    if t==length - 1:
-                        view_pos_0 = get_pos(self.g_grid, self.g_size, None, self.pos,
-                                             get_pos(self.g_grid, self.g_size, self.tail[t]), i=self.game.count,
-                                             m=self.game.time / self.game.dt)
-                        theta_0 = get_theta(self.tail_angle[t], self.theta, i=self.game.count,
-                                            m=self.game.time / self.game.dt)
-                        piece.transform = tr.matmul([
-                            tr.translate(
-                                tx=view_pos_0[0],
-                                ty=view_pos_0[1],
-                                tz=0
-                            ),
-                            tr.rotationZ(theta_0)
-                        ])
-                    else:
-                        view_pos_t = get_pos(self.g_grid, self.g_size, None, self.tail[t + 1],
-                                             get_pos(self.g_grid, self.g_size, self.tail[t]), i=self.game.count,
-                                             m=self.game.time / self.game.dt)
-                        theta_t = get_theta(self.tail_angle[t], self.tail_angle[t + 1], i=self.game.count,
-                                            m=self.game.time / self.game.dt)
-                        piece.transform = tr.matmul([
-                            tr.translate(
-                                tx=view_pos_t[0],
-                                ty=view_pos_t[1],
-                                tz=0
-                            ),
-                            tr.rotationZ(theta_t)
-                        ])
-                    sg.drawSceneGraphNode(piece, pipeline)
+                # every piece at once, already in the layout of the instance buffer when it is one
+                matrices = self.tail_transforms(columnMajor=pipeline_inst is not None)
+                if pipeline_inst is None:
+                    for piece, matrix in zip(model.childs, matrices):
+                        piece.transform = matrix
+                        queue.submitNode(piece, pipeline, self.lights)
+                elif len(matrices):
+                    body_sh = model.childs[0].childs[0]
+                    queue.submit(pipeline, body_sh.childs[0], body_sh.transform, self.lights, instances=matrices,
+                                 columnMajor=True)
+
+    def tail_transforms(self, columnMajor=False):
+        # Model matrices of the body pieces as an (N, 4, 4) stack: piece t moves from tail[t] to tail[t + 1],
+        # the last one to the head
+        i = self.game.count
+        m = self.game.time / self.game.dt
+        positions = get_pos_batch(self.g_grid, self.g_size, None, (self.tail + [self.pos])[1:],
+                                  get_pos_batch(self.g_grid, self.g_size, self.tail), i=i, m=m)
+        thetas = get_theta_batch(self.tail_angle, (self.tail_angle + [self.theta])[1:], i=i, m=m)
+        return tr.translateRotZBatch(positions[:, 0], positions[:, 1], 0, thetas, columnMajor)
+
+    def tail_segments(self):
+        # Both ends of every body piece, as tail_transforms interpolates them, for ls.Segments
+        theta_1 = np.asarray(self.tail_angle, dtype=np.float64)
+        data = np.zeros((len(self.tail), 2, 4), dtype=np.float32)
+        data[:, 0, :2] = get_pos_batch(self.g_grid, self.g_size, self.tail)
+        data[:, 0, 2:] = get_pos_batch(self.g_grid, self.g_size, (self.tail + [self.pos])[1:])
+        data[:, 1, 0] = theta_1
+        data[:, 1, 1] = get_theta_end(theta_1, (self.tail_angle + [self.theta])[1:])
+        return ls.Segments(data)
 
     def update(self):
         if not self.game.pause:
+            self.segments = None
             self.game.lock = False
             self.tail.append(self.pos)
             self.tail.pop(0)
@@ -316,6 +304,7 @@ class Snake(object):
     def set_key(self, k):
         if self.is_new_dir(k):
             self.key = k
+            self.segments = None
             self.theta = self.new_theta
             self.new_theta = self.angle[k]
             self.t0 = self.game.count
@@ -332,6 +321,7 @@ class Snake(object):
                 self.eat()
 
     def eat(self):
+        self.segments = None
         add_pos = self.food.pos if self.tail == [] else self.tail[0]
         self.tail = [add_pos] + self.tail
         add_angle = self.theta if self.tail_angle == [] else self.tail_angle[0]
@@ -350,6 +340,7 @@ class Snake(object):
         self.game.count_food = 0
         self.tail = []
         self.tail_angle = []
+        self.segments = None
         self.body.childs = [self.head]
         self.bodySnake.death()
         self.food.update(self)
@@ -367,39 +358,28 @@ class bodyCreator(object):
         self.game = game
         view_pos = get_pos(game.grid, game.size, pos)
 
-        gpu_body_quad = es.toGPUShape(bs.readOBJ('libs/obj/body.obj', (0.4, 1, 0.4), status=False))
+        gpu_body_quad = am.registry.acquireOBJ(**MESHES['body'])
 
         body_sh = sg.SceneGraphNode('body_sh')
-        body_sh.transform = tr.matmul([
-            tr.uniformScale(0.8),
-            tr.rotationZ(np.pi / 2),
-            tr.rotationX(np.pi / 2),
-            tr.uniformScale(0.01),
-            tr.translate(0, 0, 0)])
+        body_sh.transform = BODY_SHAPE
         body_sh.childs += [gpu_body_quad]
 
         body_sh_tr = sg.SceneGraphNode(f'body_sh_tr_{game.count_food}')
-        body_sh_tr.transform = tr.matmul([
-            tr.translate(
-                tx=view_pos[0],
-                ty=view_pos[1],
-                tz=0),
-            tr.rotationZ(angle)])
+        body_sh_tr.transform = tr.translateRotZ(view_pos[0], view_pos[1], 0, angle)
         body_sh_tr.childs += [body_sh]
         body.childs = [body_sh_tr] + body.childs
 
         self.model = body_sh_tr
+        self.gpu_shape = gpu_body_quad
         self.g_grid = self.game.grid
         self.g_size = self.game.size
 
-    def update(self, pos, angle):
-        view_pos = get_pos(self.g_grid, self.g_size, pos)
-        self.model.transform = tr.matmul([
-            tr.translate(
-                tx=view_pos[0],
-                ty=view_pos[1],
-                tz=0),
-            tr.rotationZ(angle)])
+    def release(self):
+        am.registry.release(self.gpu_shape)
+
+    def update(self, view_pos, angle):
+        # view_pos: position in the view of the cell, see get_pos
+        self.model.transform = tr.translateRotZ(view_pos[0], view_pos[1], 0, angle, out=self.model.transform)
 
 
 class bodySnake(object):
@@ -415,10 +395,14 @@ class bodySnake(object):
         self.list.append(bodyCreator(self.game, self.body, pos, angle))
 
     def update(self, tail, tail_angle):
-        for i in range(self.game.count_food):
-            self.list[i].update(tail[i], tail_angle[i])
+        count = self.game.count_food
+        view_pos = get_pos_batch(self.game.grid, self.game.size, tail[:count])
+        for i in range(count):
+            self.list[i].update(view_pos[i], tail_angle[i])
 
     def death(self):
+        for piece in self.list:
+            piece.release()
         self.list = []
 
 
@@ -432,15 +416,14 @@ class Food(object):
         self.view_pos = get_pos(game.grid, game.size, self.pos)
         game.view_food = self.view_pos
 
-        gpu_food_obj = es.toGPUShape(bs.readOBJ('libs/obj/lightBulb.obj', (1, 0.1, 0.1)))
+        gpu_food_levels = am.registry.acquireOBJLevels(**MESHES['food'])
 
-        food = sg.SceneGraphNode('food')
-        food.transform = tr.matmul([
+        food = sg.LODNode('food', gpu_food_levels)
+        food.transform = tr.freeze([
             tr.uniformScale(0.8 * game.grid),
             tr.rotationX(np.pi / 2),
             tr.uniformScale(0.00015),
             tr.translate(15700, -4900, 200)])
-        food.childs += [gpu_food_obj]
         food_tr = sg.SceneGraphNode('food_tr')
         food_tr.transform = tr.translate(
             tx=self.view_pos[0],
@@ -452,72 +435,33 @@ class Food(object):
         self.g_grid = self.game.grid
         self.g_size = self.game.size
 
-    def draw(self, pipeline, projection, view, theta):
-        self.model.transform = tr.matmul([
-            tr.translate(
-                tx=self.view_pos[0],
-                ty=self.view_pos[1],
-                tz=self.game.grid / 2),
-            tr.rotationZ(1.5 * theta)
-        ])
-        glUseProgram(pipeline.shaderProgram)
-
         # White light in all components: ambient, diffuse and specular.
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La1"), 0.8, 0.2, 0.0)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld1"), 1.0, 1.0, 1.0)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls1"), 1.0, 1.0, 1.0)
-
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La2"), 1.0, 1.0, 1.0)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld2"), 1.0, 1.0, 1.0)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls2"), 1.0, 1.0, 1.0)
-
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La3"), 1.0, 1.0, 1.0)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld3"), 1, 0.01, 0.01)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls3"), 1.0, 0.3, 0.3)
-
         # Object is barely visible at only ambient. Bright white for diffuse and specular components.
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka1"), 0.008, 0.008, 0.008)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd1"), 0.5, 0.5, 0.5)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks1"), 0, 0, 0)
-
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka2"), 0.2, 0.2, 0.2)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd2"), 0.1, 0.1, 0.1)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks2"), 1, 1, 1)
-
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka3"), .3, .3, .3)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd3"), 1.0, 0.7, 0.7)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks3"), 0.36, 0.36, 0.36)
-
-        # TO DO: Explore different parameter combinations to understand their effect!
-
+        # Only the positions of the snake and food lights change between frames
+        self.lights = ls.LightsBlock()
+        self.lights.setLight(1, position=(0, 0, 1.5), La=(0.8, 0.2, 0.0), Ld=(1.0, 1.0, 1.0), Ls=(1.0, 1.0, 1.0),
+                             attenuation=(-1.93, 2.04, 1.78))
+        self.lights.setLight(2, La=(1.0, 1.0, 1.0), Ld=(1.0, 1.0, 1.0), Ls=(1.0, 1.0, 1.0),
+                             attenuation=(0.78, 3.3, 0))
+        self.lights.setLight(3, La=(1.0, 1.0, 1.0), Ld=(1, 0.01, 0.01), Ls=(1.0, 0.3, 0.3),
+                             attenuation=(0.78, 3.3, 0))
+        self.lights.setMaterial(1, Ka=(0.008, 0.008, 0.008), Kd=(0.5, 0.5, 0.5), Ks=(0, 0, 0), shininess=-1)
+        self.lights.setMaterial(2, Ka=(0.2, 0.2, 0.2), Kd=(0.1, 0.1, 0.1), Ks=(1, 1, 1), shininess=100)
+        self.lights.setMaterial(3, Ka=(.3, .3, .3), Kd=(1.0, 0.7, 0.7), Ks=(0.36, 0.36, 0.36), shininess=100)
+
+    def draw(self, queue, pipeline, projection, view, theta):
+        self.model.transform = tr.translateRotZ(self.view_pos[0], self.view_pos[1], self.game.grid / 2, 1.5 * theta,
+                                                out=self.model.transform)
         viewPos = self.game.view_cam
         snakePos = self.game.view_pos
         foodPos = self.game.view_food
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition1"), 0, 0, 1.5)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition2"), snakePos[0], snakePos[1], 0.09)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition3"), foodPos[0], foodPos[1], 0.7)
-        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "viewPosition"), viewPos[0], viewPos[1],
-                    viewPos[2])
-
-        glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess1"), -1)
-        glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess2"), 100)
-        glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess3"), 100)
-
-        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation1"), -1.93)
-        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation1"), 2.04)
-        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation1"), 1.78)
-
-        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation2"), 0.78)
-        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation2"), 3.3)
-        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation2"), 0)
-
-        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation3"), 0.78)
-        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation3"), 3.3)
-        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation3"), 0)
+        self.lights.setLight(2, position=(snakePos[0], snakePos[1], 0.09))
+        self.lights.setLight(3, position=(foodPos[0], foodPos[1], 0.7))
+        self.lights.setViewPosition(viewPos[0], viewPos[1], viewPos[2])
+        self.lights.upload()
 
-        glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
-        glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "view"), 1, GL_TRUE, view)
-        sg.drawSceneGraphNode(self.model, pipeline)
+        sg.selectLOD(self.model, projection, view)
+        queue.submitNode(self.model, pipeline, self.lights)
 
     def update(self, snake):
         choice = self.game.empty - set(snake.tail) - {snake.pos}
@@ -534,46 +478,41 @@ class Background(object):
         self.game = game
         self.cam = cam
 
-        gpu_BG_quad = es.toGPUShape(
-            bs.createTextureNormalsQuad(image, game.size, game.size), GL_REPEAT,
-            GL_LINEAR)
+        gpu_BG_quad = am.registry.acquire(
+            ('quad', image, game.size, game.size),
+            lambda: bs.createTextureNormalsQuad(image, game.size, game.size), GL_REPEAT, GL_LINEAR, mipmap=True)
 
-        gpu_lamp_obj = es.toGPUShape(
-            bs.readOBJ('libs/obj/streetLamp.obj', (0.2, 0.2, 0.2)))
+        gpu_lamp_levels = am.registry.acquireOBJLevels(**MESHES['lamp'])
 
-        gpu_light_cube = es.toGPUShape(
-            bs.createColorNormalsCube(1, 1, 1))
+        gpu_light_cube = am.registry.acquire(
+            ('cube', 1, 1, 1),
+            lambda: bs.createColorNormalsCube(1, 1, 1))
 
-        gpu_wall_cube_h = es.toGPUShape(
-            bs.createTextureNormalsQuad(leaves, game.size + 1, 1), GL_REPEAT,
-            GL_LINEAR)
+        # Each wall is made of WALL_CHUNKS pieces with a whole number of cells, so the texture stays continuous
+        def wall_quads(length):
+            quads = []
+            for cells in np.array_split(np.arange(length), WALL_CHUNKS):
+                k = len(cells)
+                quads.append((cells[0] + k / 2 - length / 2, k, am.registry.acquire(
+                    ('quad', leaves, k, 1),
+                    lambda k=k: bs.createTextureNormalsQuad(leaves, k, 1), GL_REPEAT, GL_LINEAR, mipmap=True)))
+            return quads
 
-        gpu_wall_cube_v = es.toGPUShape(
-            bs.createTextureNormalsQuad(leaves, game.size, 1), GL_REPEAT,
-            GL_LINEAR)
+        gpu_wall_cube_h = wall_quads(game.size + 1)
+        gpu_wall_cube_v = wall_quads(game.size)
 
-        gpu_arc_obj = es.toGPUShape(
-            bs.readOBJ('libs/obj/ancient_wall.obj', (1, 1, 0.72), status=False))
+        gpu_arc_levels = am.registry.acquireOBJLevels(**MESHES['arc'])
 
         BG = sg.SceneGraphNode('BG')
         BG.transform = tr.uniformScale(2)  # tr.scale(2, 2, 0.001)  #
         BG.childs += [gpu_BG_quad]
 
-        arc = sg.SceneGraphNode('arc')
+        arc = sg.LODNode('arc', gpu_arc_levels)
         arc.transform = tr.matmul([
             tr.translate(-0.039, -0.049, -0.01),
             tr.rotationX(np.pi / 2),
             tr.scale(1 - 0.22, 1, 1 - 0.38),
             tr.uniformScale(0.0011)])
-        arc.childs += [gpu_arc_obj]
-
-        _lamp = sg.SceneGraphNode('_lamp')
-        _lamp.transform = tr.matmul([
-            tr.rotationZ(np.pi / 4),
-            tr.rotationX(3.14 / 2),
-            tr.uniformScale(0.00045),
-            tr.translate(0, -560, 0)])
-        _lamp.childs += [gpu_lamp_obj]
 
         light = sg.SceneGraphNode('light')
         light.transform = tr.matmul([
@@ -581,61 +520,53 @@ class Background(object):
             tr.uniformScale(0.03)])
         light.childs += [gpu_light_cube]
 
-        lamp = sg.SceneGraphNode('lamp')
-        lamp.transform = tr.uniformScale(0.8)
-        lamp.childs += [_lamp, light]
-
-        lamp1 = sg.SceneGraphNode('lamp1')
-        lamp1.transform = tr.matmul([
-            tr.translate(1, 1, 0)
-        ])
-        lamp1.childs += [lamp]
-
-        lamp2 = sg.SceneGraphNode('lamp2')
-        lamp2.transform = tr.matmul([
-            tr.translate(-1, 1, 0)
-        ])
-        lamp2.childs += [lamp]
-
-        lamp3 = sg.SceneGraphNode('lamp3')
-        lamp3.transform = tr.matmul([
-            tr.translate(1, -1, 0)
-        ])
-        lamp3.childs += [lamp]
-
-        lamp4 = sg.SceneGraphNode('lamp4')
-        lamp4.transform = tr.matmul([
-            tr.translate(-1, -1, 0)
-        ])
-        lamp4.childs += [lamp]
+        # each lamp picks its own level of detail, so only the light is shared
+        lamp_shape = tr.freeze([
+            tr.rotationZ(np.pi / 4),
+            tr.rotationX(3.14 / 2),
+            tr.uniformScale(0.00045),
+            tr.translate(0, -560, 0)])
+        lamps_tr = []
+        for i, (x, y) in enumerate([(1, 1), (-1, 1), (1, -1), (-1, -1)]):
+            _lamp = sg.LODNode(f'_lamp{i + 1}', gpu_lamp_levels)
+            _lamp.transform = lamp_shape
 
-        lamps = sg.SceneGraphNode('lamps')
-        lamps.childs += [lamp1, lamp2, lamp3, lamp4, arc]
+            lamp = sg.SceneGraphNode(f'lamp_{i + 1}')
+            lamp.transform = tr.uniformScale(0.8)
+            lamp.childs += [_lamp, light]
 
-        wall_v = sg.SceneGraphNode('wall_v')
-        wall_v.transform = tr.matmul([
-            tr.rotationX(np.pi / 2),
-            tr.uniformScale(2 * game.grid),
-            tr.translate(
-                tx=0,
-                ty=0.5,
-                tz=0),
-            tr.scale(game.size, 1, 1)])
-        wall_v.childs += [gpu_wall_cube_v]
-
-        wall_h = sg.SceneGraphNode('wall_h')
-        wall_h.transform = tr.matmul([
-            tr.rotationX(0),
-            tr.uniformScale(2 * game.grid),
-            tr.translate(
-                tx=0.5,
-                ty=0.5,
-                tz=1),
-            tr.scale(game.size + 1, 1, 1)])
-        wall_h.childs += [gpu_wall_cube_h]
+            lamp_tr = sg.SceneGraphNode(f'lamp{i + 1}')
+            lamp_tr.transform = tr.translate(x, y, 0)
+            lamp_tr.childs += [lamp]
+            lamps_tr.append(lamp_tr)
 
         wall = sg.SceneGraphNode('wall')
-        wall.childs += [wall_h, wall_v]
+        for c, ((cx_h, k_h, quad_h), (cx_v, k_v, quad_v)) in enumerate(zip(gpu_wall_cube_h, gpu_wall_cube_v)):
+            wall_v = sg.SceneGraphNode(f'wall_v{c}')
+            wall_v.transform = tr.matmul([
+                tr.rotationX(np.pi / 2),
+                tr.uniformScale(2 * game.grid),
+                tr.translate(
+                    tx=cx_v,
+                    ty=0.5,
+                    tz=0),
+                tr.scale(k_v, 1, 1)])
+            wall_v.childs += [quad_v]
+
+            wall_h = sg.SceneGraphNode(f'wall_h{c}')
+            wall_h.transform = tr.matmul([
+                tr.rotationX(0),
+                tr.uniformScale(2 * game.grid),
+                tr.translate(
+                    tx=0.5 + cx_h,
+                    ty=0.5,
+                    tz=1),
+                tr.scale(k_h, 1, 1)])
+            wall_h.childs += [quad_h]
+
+            chunk = sg.SceneGraphNode(f'wall_chunk{c}')
+            chunk.childs += [wall_h, wall_v]
+            wall.childs += [chunk]
 
         wall1 = sg.SceneGraphNode('wall1')
         wall1.transform = tr.translate(
@@ -669,104 +600,72 @@ class Background(object):
             tr.rotationZ(-np.pi / 2)])
         wall4.childs += [wall]
 
-        BG_tr = sg.SceneGraphNode('BG_tr')
-        BG_tr.childs += [BG, wall1, wall2, wall3, wall4]
+        # Nothing moves in the background: the meshes of each piece of wall sharing a texture are merged,
+        # already transformed, so the floor and each piece take a draw call. Pieces out of view are culled
+        parts = [(BG, None)] + [(chunk, side.transform) for side in [wall1, wall2, wall3, wall4]
+                                for chunk in wall.childs]
+        BG_batches = sg.SceneGraphNode('BG_batches')
+        for j, (part, side) in enumerate(parts):
+            for i, batch in enumerate(sg.batchRenderList(sg.RenderList(part, side), am.registry.source)):
+                node = sg.SceneGraphNode(f'{part.name}_batch{j}_{i}')
+                node.childs += [batch]
+                BG_batches.childs += [node]
+
+        # Each lamp is merged with its light, one mesh per level of detail: every lamp keeps its own
+        # bounding sphere, so it still picks its level from its own size on screen
+        lamps = sg.SceneGraphNode('lamps')
+        for i, lamp_tr in enumerate(lamps_tr):
+            levels = [sg.batchRenderList(sg.RenderList(lamp_tr), am.registry.source, level=level)[0]
+                      for level in range(len(gpu_lamp_levels))]
+            lamps.childs += [sg.LODNode(f'lamp_batch{i + 1}', levels)]
+        lamps.childs += [arc]
 
-        self.model_tx = BG_tr
-        self.model_col = lamps
-        self.model_arc = arc
+        self.list_tx = sg.RenderList(BG_batches)
+        self.list_col = sg.RenderList(lamps)
 
-    def draw(self, pipeline_tx, pipeline_col, projection, view, size):
-        self.model_arc.transform = tr.matmul([
-            tr.translate(-0.039, -0.049, -0.01),
-            tr.rotationX(np.pi / 2),
-            tr.scale(1 - 0.22, 1, 1 - 0.38),
-            tr.uniformScale(0.0011)])
+        # Only the batches are drawn, the meshes they were made from can be freed (see am.registry.collect)
+        wall_shapes = [quad for _, _, quad in gpu_wall_cube_h + gpu_wall_cube_v]
+        for gpu_shape in [gpu_BG_quad, gpu_light_cube] + wall_shapes + gpu_lamp_levels:
+            am.registry.release(gpu_shape)
 
-        dict = {'tx': (pipeline_tx, self.model_tx), 'col': (pipeline_col, self.model_col)}
+        # White light in all components: ambient, diffuse and specular.
+        # Object is barely visible at only ambient. Bright white for diffuse and specular components.
+        # The positions of the snake and food lights and the shininess of the lamps change between frames
+        self.lights = ls.LightsBlock()
+        self.lights.setLight(1, position=(0, 0, 2), La=(0.8, 0.2, 0.0), Ld=(1.0, 1.0, 1.0), Ls=(1.0, 1.0, 1.0),
+                             attenuation=(-1.93, 2.04, 1.78))
+        self.lights.setLight(2, La=(1.0, 1.0, 1.0), Ld=(1.0, 1.0, 1.0), Ls=(1.0, 1.0, 1.0),
+                             attenuation=(0.58, 3.3, 0))
+        self.lights.setLight(3, La=(1.0, 1.0, 1.0), Ld=(1, 0.01, 0.01), Ls=(1.0, 0.3, 0.3),
+                             attenuation=(0.78, 3.3, 0))
+        self.lights.setMaterial(1, Ka=(0.008, 0.008, 0.008), Kd=(0.5, 0.5, 0.5), Ks=(0, 0, 0), shininess=-1)
+        self.lights.setMaterial(2, Ka=(0, 0, 0), Kd=(0.7, 1.0, 0.7), Ks=(0.0, 0.0, 0.0), shininess=-1)
+        self.lights.setMaterial(3, Ka=(-0.04, -0.04, -0.04), Kd=(1.0, 0.7, 0.7), Ks=(0.36, 0.36, 0.36), shininess=100)
+        for j, lamp in LAMPS.items():
+            self.lights.setLight(3 + j, position=(0.9 * lamp[0], 0.9 * lamp[1], 0.34), La=(1.0, 1.0, 1.0),
+                                 Ld=(1, 1, 1), Ls=(1.0, 1.0, 1.0), attenuation=(0.63, 0.59, 4))
+            self.lights.setMaterial(3 + j, Ka=(-0.04, -0.04, -0.04), Kd=(0.95, 1.0, 1.0), Ks=(0.5, 0.5, 0.5))
+
+    def draw(self, queue, pipeline_tx, pipeline_col, projection, view, size):
+        viewPos = self.game.view_cam
+        snakePos = self.game.view_pos
+        foodPos = self.game.view_food
+        self.lights.setLight(2, position=(snakePos[0], snakePos[1], 0.09))
+        self.lights.setLight(3, position=(foodPos[0], foodPos[1], 0.04))
+        self.lights.setViewPosition(viewPos[0], viewPos[1], viewPos[2])
+        # the lamps flicker
+        for j, lamp in LAMPS.items():
+            self.lights.setMaterial(3 + j, shininess=int(90 + 10 * (np.sin(8 * lamp[0] * self.game.t) + np.cos(
+                5 * lamp[1] * self.game.t))))
+        self.lights.upload()
+
+        dict = {'tx': (pipeline_tx, self.list_tx), 'col': (pipeline_col, self.list_col)}
         for p in ['tx', 'col']:
             pipeline = dict[p][0]
-            glUseProgram(pipeline.shaderProgram)
-
-            # White light in all components: ambient, diffuse and specular.
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La1"), 0.8, 0.2, 0.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld1"), 1.0, 1.0, 1.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls1"), 1.0, 1.0, 1.0)
-
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La2"), 1.0, 1.0, 1.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld2"), 1.0, 1.0, 1.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls2"), 1.0, 1.0, 1.0)
-
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La3"), 1.0, 1.0, 1.0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld3"), 1, 0.01, 0.01)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls3"), 1.0, 0.3, 0.3)
-
-            # Object is barely visible at only ambient. Bright white for diffuse and specular components.
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka1"), 0.008, 0.008, 0.008)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd1"), 0.5, 0.5, 0.5)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks1"), 0, 0, 0)
-
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka2"), 0, 0, 0)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd2"), 0.7, 1.0, 0.7)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks2"), 0.0, 0.0, 0.0)
-
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka3"), -0.04, -0.04, -0.04)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd3"), 1.0, 0.7, 0.7)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks3"), 0.36, 0.36, 0.36)
-
-            # TO DO: Explore different parameter combinations to understand their effect!
-
-            viewPos = self.game.view_cam
-            snakePos = self.game.view_pos
-            foodPos = self.game.view_food
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition1"), 0, 0, 2)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition2"), snakePos[0], snakePos[1], 0.09)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition3"), foodPos[0], foodPos[1], 0.04)
-            glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "viewPosition"), viewPos[0], viewPos[1],
-                        viewPos[2])
-
-            glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess1"), -1)
-            glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess2"), -1)
-            glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess3"), 100)
-
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation1"), -1.93)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation1"), 2.04)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation1"), 1.78)
-
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation2"), 0.58)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation2"), 3.3)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation2"), 0)
-
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation3"), 0.78)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation3"), 3.3)
-            glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation3"), 0)
-
-            lamps = {1: (1, 1), 2: (-1, 1), 3: (1, -1), 4: (-1, -1)}
-            for j in range(1, size + 1):
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"La{3 + j}"), 1.0, 1.0, 1.0)
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Ld{3 + j}"), 1, 1, 1)
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Ls{3 + j}"), 1.0, 1.0, 1.0)
-
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Ka{3 + j}"), -0.04, -0.04, -0.04)
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Kd{3 + j}"), 0.95, 1.0, 1.0)
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"Ks{3 + j}"), 0.5, 0.5, 0.5)
-
-                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, f"lightPosition{3 + j}"),
-                            0.9 * lamps[j][0], 0.9 * lamps[j][1], 0.34)
-
-                glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, f"shininess{3 + j}"),
-                             int(90 + 10 * (np.sin(8 * lamps[j][0] * self.game.t) + np.cos(
-                                 5 * lamps[j][1] * self.game.t))))
-
-                glUniform1f(glGetUniformLocation(pipeline.shaderProgram, f"constantAttenuation{3 + j}"), 0.63)
-                glUniform1f(glGetUniformLocation(pipeline.shaderProgram, f"linearAttenuation{3 + j}"), 0.59)
-                glUniform1f(glGetUniformLocation(pipeline.shaderProgram, f"quadraticAttenuation{3 + j}"), 4)
-
-            glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
-            glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "view"), 1, GL_TRUE, view)
             # Drawing
-            model = dict[p][1]
-            sg.drawSceneGraphNode(model, pipeline)
+            renderList = dict[p][1]
+            renderList.selectLOD(projection, view)
+            queue.submitRenderList(renderList, pipeline, self.lights)
 
 
 class interactiveWindow(object):
@@ -804,19 +703,21 @@ class interactiveWindow(object):
         winW_tr.childs += [winW]
 
         self.models = {'dead': deadW_tr, 'pause': pauseW_tr, 'win': winW_tr}
+        # only the scale of the whole window changes, it is applied on top of the baked lists
+        self.lists = {k: sg.RenderList(model) for k, model in self.models.items()}
+        self.scale = tr.identity()
+        self.worldMatrices = {k: np.empty_like(renderList.matrices) for k, renderList in self.lists.items()}
 
-    def draw(self, pipeline, mod):
+    def draw(self, queue, pipeline, mod):
         scale = self.game.time_pause
         if scale < 2:
             self.game.time_pause += 0.005
         else:
             self.game.time_pause = 2
-        model = self.models[mod]
-        model.transform = tr.matmul([
-            tr.uniformScale(scale),
-        ])
-        glUseProgram(pipeline.shaderProgram)
-        sg.drawSceneGraphNode(model, pipeline, transformName='transform')
+        # blended on top of the scene, after every opaque draw
+        queue.submitRenderList(self.lists[mod], pipeline, transformName='transform',
+                               parentTransform=tr.uniformScale(scale, out=self.scale), layer=rq.OVERLAY,
+                               out=self.worldMatrices[mod])
 
 
 class Axis(object):
@@ -824,10 +725,10 @@ class Axis(object):
         self.model = es.toGPUShape(bs.createAxis(ln))
 
     def draw(self, pipeline, projection, view):
-        glUseProgram(pipeline.shaderProgram)
-        glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
-        glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "view"), 1, GL_TRUE, view)
-        glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "model"), 1, GL_TRUE, tr.identity())
+        pipeline.use()
+        pipeline.uniformMatrix4fv("projection", projection)
+        pipeline.uniformMatrix4fv("view", view)
+        pipeline.uniformMatrix4fv("model", tr.identity())
         pipeline.drawShape(self.model, GL_LINES)
 
 
@@ -906,3 +807,32 @@ def get_theta(theta_1, theta_2, i=0, m=1):
         return (i / m) * (2 * np.pi) + (1 - i / m) * theta_1
     else:
         return (i / m) * theta_2 + (1 - i / m) * theta_1
+
+
+# (-1) ** t of get_pos, per axis
+AXIS_SIGN = np.array([1, -1])
+
+
+def get_pos_batch(grid, size, pos, next_pos=None, current=None, i=0, m=1):
+    # get_pos for N cells at once: pos, next_pos are sequences of cells, current an (N, 2) array.
+    # Returns an (N, 2) array with the same values as get_pos
+    if current is None:
+        return grid * (AXIS_SIGN * (2 * np.reshape(np.asarray(pos, dtype=np.float64), (-1, 2)) - (size - 1)))
+    else:
+        next = get_pos_batch(grid, size, next_pos)
+        return next * (i / m) + current * (1 - i / m)
+
+
+def get_theta_end(theta_1, theta_2):
+    # theta_2 as get_theta interpolates towards it: the turns between 3pi/2 and 0 end at -pi/2 and 2pi
+    theta_1 = np.asarray(theta_1, dtype=np.float64)
+    theta_2 = np.asarray(theta_2, dtype=np.float64)
+    theta_2 = np.where((theta_1 == 0) & (theta_2 == 3 * np.pi / 2), -np.pi / 2, theta_2)
+    return np.where((theta_2 == 0) & (theta_1 == 3 * np.pi / 2), 2 * np.pi, theta_2)
+
+
+def get_theta_batch(theta_1, theta_2, i=0, m=1):
+    # get_theta for N angles at once, with the same turns between 3pi/2 and 0
+    theta_1 = np.asarray(theta_1, dtype=np.float64)
+    theta_2 = get_theta_end(theta_1, theta_2)
+    return (i / m) * theta_2 + (1 - i / m) * theta_1
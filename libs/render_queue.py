@@ -0,0 +1,139 @@
+"""
+F. Urrutia V., CC3501, 2020-1
+-----------> RENDER QUEUE <-----------
+Cola de dibujo:
+-DrawItem
+-RenderQueue: begin() fija la vista, los modelos envian sus dibujos (los subarboles fuera de la vista se
+ descartan enteros), flush() descarta los que quedan fuera, los ordena y dibuja
+"""
+
+from OpenGL.GL import *
+import numpy as np
+
+from libs import easy_shaders as es, scene_graph as sg, lighting_shaders as ls
+
+# Layers, drawn in this order. Opaque items are sorted by state, overlays keep the order they were submitted in
+OPAQUE = 0
+OVERLAY = 1
+
+
+class DrawItem(object):
+    __slots__ = ['pipeline', 'shape', 'matrix', 'lights', 'transformName', 'mode', 'instances', 'columnMajor',
+                 'layer', 'visible', 'key']
+
+    def __init__(self, pipeline, shape, matrix, lights, transformName, mode, instances, columnMajor, layer, visible,
+                 key):
+        self.pipeline = pipeline
+        self.shape = shape
+        self.matrix = matrix
+        self.lights = lights
+        self.transformName = transformName
+        self.mode = mode
+        self.instances = instances
+        self.columnMajor = columnMajor
+        self.layer = layer
+        # True when already tested against the frustum
+        self.visible = visible
+        self.key = key
+
+
+class RenderQueue(object):
+    # Draws are collected during the frame and issued together, sorted by (program, texture, VAO),
+    # so each program and texture is bound as few times as possible.
+    # With begin(), opaque subtrees and items outside of the view are dropped; frustum.endFrame() gives the
+    # meshes drawn and the meshes, instances or subtrees culled
+
+    def __init__(self):
+        self.items = []
+        self.frustum = sg.Frustum()
+
+    def begin(self, projection, view):
+        # The view of the frame, draws are culled against it from now on
+        self.frustum.update(projection, view)
+
+    def submit(self, pipeline, shape, matrix, lights=None, transformName='model', mode=GL_TRIANGLES,
+               instances=None, columnMajor=False, layer=OPAQUE, visible=False):
+        # lights: LightsBlock bound for this draw; instances, columnMajor: model matrices for drawShapeInstanced
+        if layer == OPAQUE:
+            key = (layer, pipeline.shaderProgram, shape.texture, shape.vao, id(lights))
+        else:
+            key = (layer, len(self.items))
+        self.items.append(DrawItem(pipeline, shape, matrix, lights, transformName, mode, instances, columnMajor,
+                                   layer, visible, key))
+
+    def submitNode(self, node, pipeline, lights=None, transformName='model', layer=OPAQUE, parent=None):
+        # Every leaf of the scene graph, with the same leaf rule as sg.drawSceneGraphNode.
+        # A subtree whose world bounds are out of the view is skipped as a whole
+        slot = sg.worldSlot(node, parent)
+        tested = False
+        if layer == OPAQUE and self.frustum.planes is not None:
+            sphere = sg.worldBounds(node, slot)
+            if sphere is not None:
+                if not self.frustum.visibleSphere(*sphere):
+                    self.frustum.culled += 1
+                    return
+                tested = True
+        if len(node.childs) == 1 and isinstance(node.childs[0], es.GPUShape):
+            self.submit(pipeline, node.childs[0], slot.matrix, lights, transformName, layer=layer, visible=tested)
+        else:
+            for child in node.childs:
+                self.submitNode(child, pipeline, lights, transformName, layer, slot)
+
+    def submitRenderList(self, renderList, pipeline, lights=None, transformName='model', parentTransform=None,
+                         layer=OPAQUE, out=None):
+        # out: preallocated (n, 4, 4) float32 buffer for the parent-transformed matrices, it must stay
+        # untouched until flush
+        matrices = renderList.matrices if parentTransform is None else np.matmul(parentTransform, renderList.matrices,
+                                                                                 out=out)
+        for matrix, holder in zip(matrices, renderList.holders):
+            self.submit(pipeline, holder.childs[0], matrix, lights, transformName, layer=layer)
+
+    def cull(self, item):
+        # False when nothing of item can be seen; instanced items keep only their visible instances.
+        # Overlays are not culled
+        if item.layer != OPAQUE or self.frustum.planes is None:
+            return True
+        if item.visible:
+            self.frustum.drawn += 1
+            return True
+        if item.instances is None:
+            return self.frustum.visible(item.shape, item.matrix)
+        if isinstance(item.instances, ls.Segments):
+            # placed in the vertex shader: the whole body is drawn or culled with the sphere around every segment
+            sphere = item.instances.bounds(item.shape, item.matrix)
+            visible = sphere is None or self.frustum.visibleSphere(*sphere)
+            if visible:
+                self.frustum.drawn += len(item.instances)
+            else:
+                self.frustum.culled += len(item.instances)
+            return visible
+
+        instances = np.asarray(item.instances, dtype=np.float32)
+        # world matrix of each instance: instanceModel * model
+        models = np.transpose(instances, (0, 2, 1)) if item.columnMajor else instances
+        visible = self.frustum.visibleMask(item.shape, np.matmul(models, item.matrix))
+        if not visible.all():
+            item.instances = instances[visible]
+        return bool(visible.any())
+
+    def flush(self, projection, view):
+        # Draws and empties the queue. projection and view are set once per program change
+        self.items = [item for item in self.items if self.cull(item)]
+        self.items.sort(key=lambda item: item.key)
+        current = None
+        for item in self.items:
+            pipeline = item.pipeline
+            if pipeline is not current:
+                current = pipeline
+                pipeline.use()
+                pipeline.uniformMatrix4fv("projection", projection)
+                pipeline.uniformMatrix4fv("view", view)
+            if item.lights is not None:
+                item.lights.bind()
+
+            pipeline.uniformMatrix4fv(item.transformName, item.matrix)
+            if item.instances is None:
+                pipeline.drawShape(item.shape, item.mode)
+            else:
+                pipeline.drawShapeInstanced(item.shape, item.instances, item.mode, item.columnMajor)
+        self.items = []
@@ -2,25 +2,363 @@
 """
 Daniel Calderon, CC3501, 2019-2
 A simple scene graph class and functionality
+
+F. Urrutia V., CC3501, 2020-1
+add LODNode and selectLOD
+cached world transforms (WorldSlot)
+RenderList: flattened static subtrees
+batchRenderList: static batching
+Frustum: view frustum culling with the bounding spheres of the GPUShapes
+bounds(): bounding sphere of each subtree, kept up to date through the parents
 """
 
 from OpenGL.GL import *
+import itertools
+import weakref
 import numpy as np
 
-from libs import transformations as tr, easy_shaders as es
+from libs import basic_shapes as bs, transformations as tr, easy_shaders as es
 
 
 # A simple class to handle a scene graph
 # Each node represents a group of objects
 # Each leaf represents a basic figure (GPUShape)
 # To identify each node properly, it MUST have a unique name
+# The world matrix of each node is cached and only recomputed when its transform, or the one of an
+# ancestor, is assigned again (in-place edits of a transform matrix are not detected).
+# The bounding sphere of each subtree is cached too: assigning a transform or the childs of a node marks
+# the nodes above it, which compute theirs again when asked (childs edited in place, other than +=, are
+# not detected).
 class SceneGraphNode:
     def __init__(self, name):
         self.name = name
+        # nodes having this one as a child
+        self.parents = weakref.WeakSet()
+        self._bounds = None
+        self.boundsValid = False
         self.transform = tr.identity()
         self.childs = []
+        # one WorldSlot per path reaching this node, keyed by the slot of the parent (None at the root)
+        self.worlds = weakref.WeakKeyDictionary()
+        self.rootWorld = None
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, matrix):
+        self._transform = matrix
+        self.version = next(_versions)
+        # the bounds of this subtree do not change, the ones of the parents do
+        for parent in list(self.parents):
+            parent.invalidateBounds()
+
+    @property
+    def childs(self):
+        return self._childs
+
+    @childs.setter
+    def childs(self, childs):
+        self._childs = childs
+        for child in childs:
+            if isinstance(child, SceneGraphNode):
+                child.parents.add(self)
+        self.invalidateBounds()
+
+    def invalidateBounds(self):
+        # Nodes with valid bounds only have valid bounds below, so the walk up stops at the first invalid one
+        if self.boundsValid:
+            self.boundsValid = False
+            for parent in list(self.parents):
+                parent.invalidateBounds()
+
+    def bounds(self):
+        # Bounding sphere (center, radius) of the subtree, in the coordinates of this node (its own transform
+        # not applied). None when unknown: some leaf has no bounds
+        if not self.boundsValid:
+            spheres = []
+            for child in self.childs:
+                if isinstance(child, es.GPUShape):
+                    sphere = None if child.center is None else (np.asarray(child.center, dtype=np.float32),
+                                                                child.radius)
+                else:
+                    sphere = child.bounds()
+                    if sphere is not None:
+                        sphere = transformSphere(sphere, child.transform)
+                if sphere is None:
+                    spheres = None
+                    break
+                spheres.append(sphere)
+            self._bounds = mergeSpheres(spheres) if spheres else None
+            self.boundsValid = True
+        return self._bounds
+
+
+# Every new matrix gets a different version, so a version change means "recompute below"
+_versions = itertools.count(1)
+
+
+class WorldSlot:
+    def __init__(self):
+        self.matrix = None
+        self.version = 0
+        self.parentVersion = -1
+        self.localVersion = -1
+        # world bounding sphere of the subtree below, see worldBounds
+        self.sphere = None
+        self.sphereVersion = -1
+        self.sphereSource = None
+
+
+def worldSlot(node, parent=None):
+    # Cached world matrix of node, below the parent slot (None: node is the root)
+    if parent is None:
+        slot = node.rootWorld
+        if slot is None:
+            slot = node.rootWorld = WorldSlot()
+        parentVersion = 0
+    else:
+        slot = node.worlds.get(parent)
+        if slot is None:
+            slot = node.worlds[parent] = WorldSlot()
+        parentVersion = parent.version
+
+    if slot.parentVersion != parentVersion or slot.localVersion != node.version:
+        slot.matrix = node.transform if parent is None else np.matmul(parent.matrix, node.transform)
+        slot.parentVersion = parentVersion
+        slot.localVersion = node.version
+        slot.version = next(_versions)
+    return slot
+
+
+def transformSphere(sphere, matrix):
+    # sphere (center, radius) moved by matrix; the radius grows with its largest scale
+    center, radius = sphere
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scale = float(np.linalg.norm(matrix[0:3, 0:3], axis=0).max())
+    return np.matmul(matrix[0:3, 0:3], center) + matrix[0:3, 3], radius * scale
+
+
+def mergeSpheres(spheres):
+    # A sphere around every given one, centered in the box around them
+    centers = np.array([center for center, _ in spheres], dtype=np.float32).reshape(-1, 3)
+    radii = np.array([radius for _, radius in spheres], dtype=np.float32)
+    center = ((centers - radii[:, None]).min(axis=0) + (centers + radii[:, None]).max(axis=0)) / 2
+    return center, float((np.linalg.norm(centers - center, axis=1) + radii).max())
+
+
+def worldBounds(node, slot):
+    # World bounding sphere of the subtree of node, placed by its slot. Cached in the slot until its matrix
+    # or the bounds of the subtree change
+    sphere = node.bounds()
+    if sphere is None:
+        return None
+    if slot.sphereVersion != slot.version or slot.sphereSource is not sphere:
+        slot.sphere = transformSphere(sphere, slot.matrix)
+        slot.sphereVersion = slot.version
+        slot.sphereSource = sphere
+    return slot.sphere
+
+
+def worldSpheres(shape, matrices):
+    # Bounding spheres of shape placed by each of the (N, 4, 4) matrices: (N, 3) centers and (N,) radii.
+    # A shape without bounds gets an infinite radius, it is never culled
+    matrices = np.asarray(matrices, dtype=np.float32)
+    if shape.center is None:
+        return np.zeros((len(matrices), 3), dtype=np.float32), np.full(len(matrices), np.inf, dtype=np.float32)
+    centers = np.matmul(matrices[:, 0:3, 0:3], shape.center) + matrices[:, 0:3, 3]
+    # the largest scale of each matrix (norm of its columns)
+    scales = np.linalg.norm(matrices[:, 0:3, 0:3], axis=1).max(axis=1)
+    return centers, shape.radius * scales
+
+
+def parentSlot(parentTransform):
+    # An explicit parent matrix can not be tracked, its slot is new on every call
+    if parentTransform is None:
+        return None
+    slot = WorldSlot()
+    slot.matrix = parentTransform
+    slot.version = next(_versions)
+    return slot
+
+
+
+# A node whose leaf is chosen among several levels of detail of the same mesh.
+# levels[0] is the full detail mesh, its bounding sphere is used to measure the size on screen.
+# thresholds: minimum fraction of the screen height covered by the mesh to use each level
+class LODNode(SceneGraphNode):
+    def __init__(self, name, levels, thresholds=(0.25, 0.08)):
+        super().__init__(name)
+        assert len(thresholds) >= len(levels) - 1
+        assert levels[0].center is not None, "The bounding sphere of the mesh is unknown."
+        self.levels = levels
+        self.radius = levels[0].radius
+        self.center = np.array(list(levels[0].center) + [1], dtype=np.float32)
+        self.thresholds = thresholds
+        self.level = 0
+        self.childs = [levels[0]]
+
+    def select(self, worldTransform, projection, view):
+        # Clip space w is the distance to the camera (perspective) or 1 (orthographic)
+        clip = np.matmul(projection, np.matmul(view, np.matmul(worldTransform, self.center)))
+        distance = max(abs(float(clip[3])), 1e-6)
+        scale = float(np.linalg.norm(worldTransform[0:3, 0:3], axis=0).max())
+        coverage = self.radius * scale * abs(float(projection[1][1])) / distance
+
+        level = 0
+        while level < len(self.levels) - 1 and coverage < self.thresholds[level]:
+            level += 1
+        if level != self.level:
+            self.level = level
+            self.childs = [self.levels[level]]
+
+    def bounds(self):
+        # The full detail sphere, whatever the level drawn
+        return self.center[0:3], self.radius
+
+
+def selectLOD(node, projection, view, parentTransform=None, parent=None):
+    # Chooses the level of every LODNode in the graph from its size on screen
+    if isinstance(node, es.GPUShape):
+        return
+
+    if parent is None:
+        parent = parentSlot(parentTransform)
+    slot = worldSlot(node, parent)
+    if isinstance(node, LODNode):
+        node.select(slot.matrix, projection, view)
+        return
+
+    for child in node.childs:
+        selectLOD(child, projection, view, parent=slot)
+
+
+# The view volume of projection·view as 6 planes (a, b, c, d) in world coordinates: a point is inside when
+# a x + b y + c z + d >= 0 for every plane. Spheres touching the volume are kept.
+# drawn / culled count the spheres tested since the last endFrame()
+class Frustum:
+    def __init__(self, projection=None, view=None):
+        self.planes = None
+        self.drawn = 0
+        self.culled = 0
+        if projection is not None:
+            self.update(projection, view)
+
+    def update(self, projection, view):
+        m = np.matmul(projection, view)
+        planes = np.array([m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1], m[3] + m[2], m[3] - m[2]],
+                          dtype=np.float32)
+        self.planes = planes / np.linalg.norm(planes[:, 0:3], axis=1, keepdims=True)
+
+    def visibleSpheres(self, centers, radii):
+        # (N,) mask of the spheres inside or crossing the volume
+        distances = np.matmul(centers, self.planes[:, 0:3].T) + self.planes[:, 3]
+        mask = (distances >= -np.reshape(radii, (-1, 1))).all(axis=1)
+        drawn = int(np.count_nonzero(mask))
+        self.drawn += drawn
+        self.culled += len(mask) - drawn
+        return mask
+
+    def visibleMask(self, shape, matrices):
+        # (N,) mask of the instances of shape, placed by the (N, 4, 4) matrices, that may be seen
+        return self.visibleSpheres(*worldSpheres(shape, matrices))
+
+    def visible(self, shape, matrix):
+        return bool(self.visibleMask(shape, np.reshape(matrix, (1, 4, 4)))[0])
+
+    def visibleSphere(self, center, radius):
+        # One sphere, not counted (the caller knows what it stands for)
+        return bool(((np.matmul(self.planes[:, 0:3], center) + self.planes[:, 3]) >= -radius).all())
+
+    def endFrame(self):
+        # Returns (drawn, culled) since the last call
+        counts = self.drawn, self.culled
+        self.drawn = self.culled = 0
+        return counts
+
+
+# A subtree flattened into its leaves: world matrices as a single (N, 4, 4) array and, for each one,
+# the node holding the GPUShape (a LODNode keeps choosing its level). Drawing it walks no graph.
+# The list does not follow later changes of the graph, update() bakes it again when a transform changed.
+class RenderList:
+    def __init__(self, node, parentTransform=None):
+        self.node = node
+        self.parentTransform = parentTransform
+        self.bake()
+
+    def bake(self):
+        matrices = []
+        self.holders = []
+        # every node of the subtree, with the version of its transform when baked
+        self.versions = []
+        self._collect(self.node, parentSlot(self.parentTransform), matrices)
+        self.matrices = np.array(matrices, dtype=np.float32).reshape(-1, 4, 4)
+        self.lods = [i for i, holder in enumerate(self.holders) if isinstance(holder, LODNode)]
+
+    def _collect(self, node, parent, matrices):
+        slot = worldSlot(node, parent)
+        self.versions.append((node, node.version))
+
+        # Same leaf rule as drawSceneGraphNode
+        if isinstance(node, LODNode) or (len(node.childs) == 1 and isinstance(node.childs[0], es.GPUShape)):
+            matrices.append(slot.matrix)
+            self.holders.append(node)
+        else:
+            for child in node.childs:
+                self._collect(child, slot, matrices)
+
+    def changed(self):
+        return any(node.version != version for node, version in self.versions)
+
+    def update(self):
+        # Bakes again if some transform of the subtree was assigned since the last bake
+        if self.changed():
+            self.bake()
+
+    def selectLOD(self, projection, view):
+        for i in self.lods:
+            self.holders[i].select(self.matrices[i], projection, view)
+
+    def draw(self, pipeline, transformName='model', parentTransform=None):
+        # parentTransform is applied to every record at once, the baked matrices are kept
+        matrices = self.matrices if parentTransform is None else np.matmul(parentTransform, self.matrices)
+        for matrix, holder in zip(matrices, self.holders):
+            pipeline.uniformMatrix4fv(transformName, matrix)
+            pipeline.drawShape(holder.childs[0])
+
+
+def batchRenderList(renderList, sourceOf, level=0):
+    # Leaves of a static render list merged, already in world coordinates, into one GPUShape per texture.
+    # sourceOf(gpuShape) gives back the Shape uploaded as gpuShape; LODNodes contribute their given level.
+    # The batches share the textures of the leaves (one more reference each), drawn with the identity as model.
+    sources = {}
+    groups = {}
+    layouts = {}
+    for matrix, holder in zip(renderList.matrices, renderList.holders):
+        if isinstance(holder, LODNode):
+            leaf = holder.levels[min(level, len(holder.levels) - 1)]
+        else:
+            leaf = holder.childs[0]
+        if leaf not in sources:
+            sources[leaf] = sourceOf(leaf)
+        groups.setdefault(leaf.texture, []).append((sources[leaf], matrix))
+        layouts.setdefault(leaf.texture, leaf.layout)
+
+    batches = []
+    for texture, parts in groups.items():
+        # the layout the leaves were uploaded with (guessed for shapes made elsewhere)
+        layout = layouts[texture] or es.vertexLayout(parts[0][0])
+        stride = es.layoutStride(layout)
+        shape = bs.mergeShapes(parts, stride)
+        gpuShape = es.toGPUShape(bs.Shape(shape.vertices, shape.indices), layout=layout)
+        if texture:
+            es.retainTexture(texture)
+            gpuShape.texture = texture
+        batches.append(gpuShape)
+    return batches
+
 
-    
 def findNode(node, name):
 
     # The name was not found in this path
@@ -74,22 +412,24 @@ def findPosition(node, name, parentTransform=tr.identity()):
     return None
 
 
-def drawSceneGraphNode(node, pipeline, parentTransform=tr.identity(), transformName='model'):
+def drawSceneGraphNode(node, pipeline, parentTransform=None, transformName='model', parent=None):
     # assert (isinstance(node, SceneGraphNode))
 
-    # Composing the transformations through this path
-    newTransform = np.matmul(parentTransform, node.transform)
+    # Composing the transformations through this path (cached until a transform changes)
+    if parent is None:
+        parent = parentSlot(parentTransform)
+    slot = worldSlot(node, parent)
 
     # If the child node is a leaf, it should be a GPUShape.
     # Hence, it can be drawn with drawShape
     if len(node.childs) == 1 and isinstance(node.childs[0], es.GPUShape):
         leaf = node.childs[0]
-        glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, transformName), 1, GL_TRUE, newTransform)
+        pipeline.uniformMatrix4fv(transformName, slot.matrix)
         pipeline.drawShape(leaf)
 
     # If the child node is not a leaf, it MUST be a SceneGraphNode,
     # so this draw function is called recursively
     else:
         for child in node.childs:
-            drawSceneGraphNode(child, pipeline, newTransform, transformName)
+            drawSceneGraphNode(child, pipeline, transformName=transformName, parent=slot)
 
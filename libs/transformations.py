@@ -3,9 +3,14 @@
 Daniel Calderon, CC3501, 2019-1
 Transformation matrices for computer graphics
 v2.0
+
+F. Urrutia V., CC3501, 2020-1
+v2.1: fused builders (written in place) and frozen constant chains
+v2.2: translateRotZBatch, (N, 4, 4) stacks
 """
 
 
+import math
 import numpy as np
 
 
@@ -13,7 +18,11 @@ def identity():
     return np.identity(4, dtype=np.float32)
 
 
-def uniformScale(s):
+def uniformScale(s, out=None):
+    if out is not None:
+        out.reshape(16)[:] = (s,0,0,0, 0,s,0,0, 0,0,s,0, 0,0,0,1)
+        return out
+
     return np.array([
         [s,0,0,0],
         [0,s,0,0],
@@ -116,6 +125,53 @@ def matmul(mats):
     return out
 
 
+# Fused builders: the product is written directly, without the intermediate matrices.
+# With out (a float32 4x4 array owned by the caller) nothing is allocated, out is returned
+
+
+def translateRotZ(tx, ty, tz, theta, out=None):
+    # matmul([translate(tx, ty, tz), rotationZ(theta)])
+    if out is None:
+        out = np.empty((4, 4), dtype=np.float32)
+    c = math.cos(theta)
+    s = math.sin(theta)
+    out.reshape(16)[:] = (c,-s,0,tx, s,c,0,ty, 0,0,1,tz, 0,0,0,1)
+    return out
+
+
+def translateRotZBatch(tx, ty, tz, theta, columnMajor=False):
+    # translateRotZ for N values at once (arrays or scalars), as an (N, 4, 4) float32 stack.
+    # columnMajor: every matrix transposed, the layout OpenGL reads, so the stack is an instance buffer as is
+    theta = np.asarray(theta, dtype=np.float32)
+    c = np.cos(theta)
+    s = np.sin(theta)
+    out = np.zeros((theta.shape[0], 4, 4), dtype=np.float32)
+    out[:, 0, 0] = c
+    out[:, 1, 1] = c
+    out[:, 2, 2] = 1
+    out[:, 3, 3] = 1
+    if columnMajor:
+        out[:, 0, 1] = s
+        out[:, 1, 0] = -s
+        out[:, 3, 0] = tx
+        out[:, 3, 1] = ty
+        out[:, 3, 2] = tz
+    else:
+        out[:, 0, 1] = -s
+        out[:, 1, 0] = s
+        out[:, 0, 3] = tx
+        out[:, 1, 3] = ty
+        out[:, 2, 3] = tz
+    return out
+
+
+def freeze(mats):
+    # A constant chain folded once, read-only so it can be shared and never used as out by mistake
+    out = np.array(matmul(mats), dtype=np.float32)
+    out.setflags(write=False)
+    return out
+
+
 def frustum(left, right, bottom, top, near, far):
     r_l = right - left
     t_b = top - bottom
@@ -4,14 +4,31 @@ F. Urrutia V., CC3501, 2020-1
          Visualización
 """
 import glfw
+import glob
+import os
 import sys
+import time
 from libs.models import *
 from libs.controller import Controller
+from libs.gl_state import state as gl
 
 N = 20
+# Shader variants are compiled ahead only when a frame ends before this fraction of 1/60 s
+IDLE_FRAME = 0.5 / 60
+# SNAKE_GL_STATS=1 prints, once per second, the GL calls issued and skipped per frame (see gl_state),
+# and the meshes drawn and culled (see sg.Frustum)
+GL_STATS = os.environ.get('SNAKE_GL_STATS', '0') != '0'
+# SNAKE_BODY: 'instanced' matrices built on the CPU every frame, 'gpu' interpolated in the vertex shader
+# (only uploaded once per tick), 'nodes' one draw per piece
+BODY = os.environ.get('SNAKE_BODY', 'instanced')
 fullScreen = 0 if len(sys.argv) == 1 else 1 if int(sys.argv[1]) == 1 else 0
 
 if __name__ == '__main__':
+    t_start = time.perf_counter()
+
+    # OBJ and PNG files are decoded in other processes while the window and shaders are created
+    preloader = am.Preloader(preload_meshes(), sorted(glob.glob('libs/fig/*.png')))
+
     if not glfw.init():
         sys.exit()
 
@@ -39,8 +56,13 @@ if __name__ == '__main__':
     glfw.set_key_callback(window, controller.on_key)
     glfw.set_scroll_callback(window, controller.on_scroll)
 
-    pipelines_ls_col = [ls.SimplePhongShaderProgramMulti(i) for i in range(3, 8)]
-    pipelines_ls_tx = [ls.SimpleTexturePhongShaderProgramMulti(i) for i in range(3, 8)]
+    # A light count variant is compiled when first drawn, or ahead of time on idle frames
+    pipelines_ls_col = ls.ShaderVariants(ls.SimplePhongShaderProgramMulti)
+    pipelines_ls_tx = ls.ShaderVariants(ls.SimpleTexturePhongShaderProgramMulti)
+    pipelines_ls_inst = ls.ShaderVariants(ls.SimplePhongShaderProgramMultiInstanced)
+    pipelines_ls_seg = ls.ShaderVariants(ls.SimplePhongShaderProgramMultiSegments)
+    pipelines_ls = [pipelines_ls_col, pipelines_ls_tx,
+                    {'instanced': pipelines_ls_inst, 'gpu': pipelines_ls_seg}.get(BODY, pipelines_ls_inst)]
 
     pipeline_tx_2d = es.SimpleTextureTransformShaderProgram()
 
@@ -59,10 +81,18 @@ if __name__ == '__main__':
     cam = Cam(game)
     bg = Background(game, cam, 'libs/fig/bricks.png', 'libs/fig/leaves.png')
 
+    preloader.shutdown()
+    # The meshes the background batches were made from are released by now
+    am.registry.collect()
+
     controller.set_snake(snake)
     controller.set_game(game)
     controller.set_cam(cam)
 
+    queue = rq.RenderQueue()
+    first_frame = True
+    stats_t, stats_frames, stats_issued, stats_elided = glfw.get_time(), 0, 0, 0
+    stats_drawn, stats_culled = 0, 0
     while not glfw.window_should_close(window):
 
         ti = glfw.get_time()
@@ -73,26 +103,66 @@ if __name__ == '__main__':
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
         projection, view = cam.get_cam()
+        # the draws submitted from here on are culled against this view
+        queue.begin(projection, view)
         top = game.count_food
         if top > 3:
             top = 4
 
-        bg.draw(pipelines_ls_tx[top], pipelines_ls_col[top], projection, view, top)
-        food.draw(pipelines_ls_col[0], projection, view, ti)
-        snake.draw(pipelines_ls_col[top], projection, view, top)
+        bg.draw(queue, pipelines_ls_tx[top], pipelines_ls_col[top], projection, view, top)
+        food.draw(queue, pipelines_ls_col[0], projection, view, ti)
+        if BODY == 'gpu':
+            snake.draw(queue, pipelines_ls_col[top], top, pipeline_seg=pipelines_ls_seg[top])
+        elif BODY == 'nodes':
+            snake.draw(queue, pipelines_ls_col[top], top)
+        else:
+            snake.draw(queue, pipelines_ls_col[top], top, pipelines_ls_inst[top])
 
         if game.pause or game.dead or game.win or game.speed:
             if game.pause:
-                iW.draw(pipeline_tx_2d, 'pause')
+                iW.draw(queue, pipeline_tx_2d, 'pause')
             elif game.win:
-                iW.draw(pipeline_tx_2d, 'win')
+                iW.draw(queue, pipeline_tx_2d, 'win')
             elif game.dead:
-                iW.draw(pipeline_tx_2d, 'dead')
+                iW.draw(queue, pipeline_tx_2d, 'dead')
+
+        # Everything submitted this frame, sorted by program, texture and mesh
+        queue.flush(projection, view)
 
         if game.check_time():
             snake.update()
             snake.collide()
 
+        # time spent in this frame, without waiting for the swap
+        busy = glfw.get_time() - ti
         glfw.swap_buffers(window)
         game.count_time()
+
+        # One variant per idle frame, starting with the next light count to be used
+        if busy < IDLE_FRAME:
+            for variants in pipelines_ls:
+                if variants.compileNext(top + 1):
+                    break
+
+        issued, elided = gl.endFrame()
+        drawn, culled = queue.frustum.endFrame()
+        if GL_STATS:
+            stats_frames += 1
+            stats_issued += issued
+            stats_elided += elided
+            stats_drawn += drawn
+            stats_culled += culled
+            if ti - stats_t >= 1:
+                print(f"GL calls per frame: {stats_issued / stats_frames:.0f} issued, "
+                      f"{stats_elided / stats_frames:.0f} skipped; meshes per frame: "
+                      f"{stats_drawn / stats_frames:.0f} drawn, {stats_culled / stats_frames:.0f} culled")
+                stats_t, stats_frames, stats_issued, stats_elided = ti, 0, 0, 0
+                stats_drawn, stats_culled = 0, 0
+
+        if first_frame:
+            first_frame = False
+            print(f"Time to first frame: {time.perf_counter() - t_start:.3f} s")
+
+    # Scene teardown: every mesh is freed while the context lives
+    am.registry.clear()
     glfw.terminate()